@@ -1,7 +1,23 @@
+import asyncio
+import hashlib
 import io
 import json
-from PIL import Image
+import mmap
+import os
+import random
+import time
+from dataclasses import dataclass
+import numpy as np
+from PIL import Image, ImageOps
 from logging_config import logger
+from metrics_utils import stage_timer, observe_stage
+from dedup_utils import dhash, near_duplicates_enabled
+from download_utils import IMAGE_MAX_PIXELS, JPEG_MAX_DRAFT_SCALE, ImageTooLarge, get_downloader
+from gemini_utils import FATAL, GeminiRequestError, classify_error
+from image_cache_utils import download_image_cached
+from dotenv import load_dotenv
+
+load_dotenv()
 
 
 # Example categories
@@ -15,7 +31,8 @@ CATEGORIES = {
     'BR': 'Contains brand logos',
     'CP': 'Copyright/movie content',
     'PL': 'Recognizable places',
-    'PP': 'Recognizable people'
+    'PP': 'Recognizable people',
+    'BL': 'Blank, uniform or broken image'
 }
 
 ANALYSIS_PROMPT = """
@@ -49,55 +66,336 @@ Respond in this exact format (replace Yes/No with true/false):
 }
 """
 
-import pycurl
-from io import BytesIO
+BATCH_ANALYSIS_PROMPT = """
+You will receive {count} images, each preceded by its label "Image 1" to "Image {count}".
+Analyze every image separately and check for the following:
+1. Text content and spelling
+2. Watermarks
+3. Human presence
+4. Nudity or inappropriate content
+5. Blood or violence
+6. Brand logos or trademarks
+7. Copyright or movie content
+8. Recognizable places
+9. Recognizable people
+
+Respond with a JSON array containing exactly {count} objects, one per image in order,
+each in this exact format (replace Yes/No with true/false):
+{{
+    "image": <image number>,
+    "text_present": Yes/No,
+    "text_analysis": {{
+        "has_spelling_errors": Yes/No,
+        "correct_spelling": Yes/No
+    }},
+    "watermark_present": Yes/No,
+    "contains_humans": Yes/No,
+    "contains_nudity": Yes/No,
+    "contains_blood_violence": Yes/No,
+    "contains_brands": Yes/No,
+    "copyright_content": Yes/No,
+    "recognizable_places": Yes/No,
+    "recognizable_people": Yes/No,
+    "details": "Describe what you found in this image"
+}}
+"""
+
+# Opt-in multi-image batching: 1 sends one image per request
+ANALYSIS_BATCH_SIZE = int(os.getenv("ANALYSIS_BATCH_SIZE", "1"))
+# Seconds to wait for a batch to fill before sending it anyway
+ANALYSIS_BATCH_LINGER = float(os.getenv("ANALYSIS_BATCH_LINGER", "0.2"))
+# Fraction of batched images that are also analyzed alone to check accuracy parity
+ANALYSIS_BATCH_PARITY_RATE = float(os.getenv("ANALYSIS_BATCH_PARITY_RATE", "0"))
 
 def download_image(url: str) -> bytes:
-    """Download image from the URL using pycurl and return as bytes."""
-    buffer = BytesIO()
-    headers = [
-        "accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
-        "accept-language: en-GB,en;q=0.9",
-        "priority: u=0, i",
-        "sec-ch-ua: \"Google Chrome\";v=\"131\", \"Chromium\";v=\"131\", \"Not_A Brand\";v=\"24\"",
-        "sec-ch-ua-mobile: ?0",
-        "sec-ch-ua-platform: \"Windows\"",
-        "sec-fetch-dest: document",
-        "sec-fetch-mode: navigate",
-        "sec-fetch-site: none",
-        "sec-fetch-user: ?1",
-        "upgrade-insecure-requests: 1",
-        "user-agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
-    ]
-
-    c = pycurl.Curl()
-    c.setopt(c.URL, url)
-    c.setopt(c.WRITEDATA, buffer)
-    c.setopt(c.HTTPHEADER, headers)
+    """Download image from the URL through the image cache and the shared pooled downloader."""
+    return download_image_cached(url)
 
-    try:
-        c.perform()
-        c.close()
-    except pycurl.error as e:
-        c.close()
-        raise RuntimeError(f"Failed to download image: {e}")
 
-    return buffer.getvalue()
+# Formats where re-encoding at a lower quality actually shrinks the payload
+LOSSY_FORMATS = {"JPEG", "WEBP"}
+
+@dataclass(frozen=True)
+class PreprocessPolicy:
+    """
+    How an image is shrunk before it is sent to the model.
+    max_edge caps the longest side in pixels (0 keeps the resolution) and
+    output_format re-encodes to JPEG/WEBP (None keeps the source format).
+    Bump the version whenever the behaviour changes so results can be compared.
+    """
+    version: str
+    max_edge: int = 0
+    output_format: str = None
+    quality: int = 85
+
+PREPROCESS_POLICIES = {
+    # Legacy behaviour: same-format re-save of lossy images only
+    "v0": PreprocessPolicy("v0"),
+    "v1": PreprocessPolicy("v1", max_edge=1536, output_format="JPEG", quality=85),
+    "v2": PreprocessPolicy("v2", max_edge=1024, output_format="WEBP", quality=80),
+}
 
+# Policy used for every image, optionally split with a second policy for A/B tests
+PREPROCESS_POLICY = os.getenv("PREPROCESS_POLICY", "v1")
+PREPROCESS_POLICY_B = os.getenv("PREPROCESS_POLICY_B")
+PREPROCESS_POLICY_B_PERCENT = int(os.getenv("PREPROCESS_POLICY_B_PERCENT", "0"))
 
-# Compress the image to reduce size
-def compress_image(image_bytes: bytes, quality: int = 85) -> bytes:
-    """Compress image bytes and return compressed bytes."""
+def select_preprocess_policy(key: str = "") -> PreprocessPolicy:
+    """
+    Pick the preprocessing policy for an image.
+    The A/B split is deterministic on `key` (e.g. the job id) so all images of
+    a job and any retries of them use the same policy.
+    """
+    if PREPROCESS_POLICY_B and PREPROCESS_POLICY_B_PERCENT > 0:
+        bucket = int(hashlib.sha1(key.encode()).hexdigest(), 16) % 100
+        if bucket < PREPROCESS_POLICY_B_PERCENT:
+            return PREPROCESS_POLICIES[PREPROCESS_POLICY_B]
+    return PREPROCESS_POLICIES[PREPROCESS_POLICY]
+
+# Local pre-screen of blank, uniform or broken renders before any model call
+PRESCREEN_ENABLED = os.getenv("PRESCREEN_ENABLED", "false").lower() == "true"
+# Grey-level variance (0-255 scale) below which the image counts as blank
+PRESCREEN_MIN_VARIANCE = float(os.getenv("PRESCREEN_MIN_VARIANCE", "4"))
+# Histogram entropy (bits) and share of edge pixels below which the image counts as uniform
+PRESCREEN_MIN_ENTROPY = float(os.getenv("PRESCREEN_MIN_ENTROPY", "1"))
+PRESCREEN_MIN_EDGE_DENSITY = float(os.getenv("PRESCREEN_MIN_EDGE_DENSITY", "0.005"))
+# Longest/shortest side ratio above which the render is treated as broken
+PRESCREEN_MAX_ASPECT_RATIO = float(os.getenv("PRESCREEN_MAX_ASPECT_RATIO", "20"))
+# Neighbouring grey-level difference that counts as an edge
+PRESCREEN_EDGE_DELTA = 16
+PRESCREEN_THUMBNAIL = (64, 64)
+
+# Marker prefixed to the details of pre-screen verdicts so they can be told apart from model verdicts
+PRESCREEN_MARKER = "[prescreen]"
+
+PRESCREEN_STATS = {"screened": 0, "short_circuited": 0}
+
+@dataclass(frozen=True)
+class ImageStats:
+    """Cheap pixel statistics of an image, computed on a small greyscale thumbnail."""
+    variance: float
+    entropy: float
+    edge_density: float
+    aspect_ratio: float
+
+def _eight_bit(img: Image.Image) -> Image.Image:
+    """Scale 16-bit greyscale ("I;16" or "I") to "L"; convert("L") would clip it at 255."""
+    return Image.fromarray(np.clip(np.asarray(img, dtype=np.int32) // 257, 0, 255).astype(np.uint8), "L")
+
+def image_stats(img: Image.Image) -> ImageStats:
+    """Compute variance, histogram entropy, edge density and aspect ratio of a decoded image."""
+    width, height = img.size
+    # BOX resizes every mode, including 16-bit greyscale, which BILINEAR rejects
+    thumb = img.resize(_fitted_size(img.size, PRESCREEN_THUMBNAIL), Image.BOX)
+    thumb = _eight_bit(thumb) if thumb.mode.startswith("I") else thumb.convert("L")
+    pixels = np.asarray(thumb, dtype=np.int16)
+
+    histogram = np.bincount(pixels.ravel(), minlength=256) / pixels.size
+    nonzero = histogram[histogram > 0]
+    entropy = max(0.0, float(-(nonzero * np.log2(nonzero)).sum()))
+
+    edges = (np.abs(np.diff(pixels, axis=1)) > PRESCREEN_EDGE_DELTA).sum() \
+        + (np.abs(np.diff(pixels, axis=0)) > PRESCREEN_EDGE_DELTA).sum()
+    edge_density = float(edges) / max(1, 2 * pixels.size)
+
+    return ImageStats(variance=float(pixels.var()), entropy=entropy, edge_density=edge_density,
+                      aspect_ratio=max(width, height) / max(1, min(width, height)))
+
+@dataclass
+class PreparedImage:
+    """An image decoded once, with the bytes to send to the model and its metadata."""
+    data: bytes
+    format: str
+    size: tuple
+    mode: str
+    source_bytes: int
+    sent_size: tuple = None
+    policy_version: str = None
+    dhash: int = None
+    stats: ImageStats = None
+
+    @property
+    def mime_type(self) -> str:
+        return Image.MIME.get(self.format, f"image/{self.format.lower()}")
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.source_bytes - len(self.data)
+
+    def as_part(self) -> dict:
+        """Return the inline image part for generate_content."""
+        return {'mime_type': self.mime_type, 'data': self.data}
+
+def _scaled_size(size: tuple, max_edge: int) -> tuple:
+    """Return `size` scaled down so its longest edge is at most max_edge."""
+    width, height = size
+    longest = max(width, height)
+    if not max_edge or longest <= max_edge:
+        return size
+    scale = max_edge / longest
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def _fitted_size(size: tuple, box: tuple) -> tuple:
+    """Return `size` scaled down (keeping the aspect ratio) to fit in box, like Image.thumbnail."""
+    width, height = size
+    scale = min(1.0, box[0] / width, box[1] / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def _capped_size(size: tuple, max_pixels: int) -> tuple:
+    """Return `size` scaled down to at most max_pixels pixels."""
+    width, height = size
+    if not max_pixels or width * height <= max_pixels:
+        return size
+    scale = (max_pixels / (width * height)) ** 0.5
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def _image_source(image_bytes):
+    if isinstance(image_bytes, mmap.mmap):
+        # Cached images are memory-mapped; Pillow reads them in place
+        image_bytes.seek(0)
+        return image_bytes
+    return io.BytesIO(image_bytes)
+
+def decoded_size(image_bytes: bytes, policy: PreprocessPolicy = None) -> int:
+    """
+    Estimate the bytes prepare_image holds for the decoded bitmap, from the
+    image header: width x height x bands, after JPEG draft downscaling and the
+    IMAGE_MAX_PIXELS cap. Returns 0 if the header cannot be read.
+    """
+    policy = policy or PREPROCESS_POLICIES[PREPROCESS_POLICY]
+    try:
+        with Image.open(_image_source(image_bytes)) as img:
+            format_, (width, height), bands = img.format, img.size, len(img.getbands())
+    except Exception:
+        return 0
+    if format_ == "JPEG":
+        target = _capped_size(_scaled_size((width, height), policy.max_edge), IMAGE_MAX_PIXELS)
+        # draft() picks the largest scale that still covers the target size
+        scale = 1
+        while scale < JPEG_MAX_DRAFT_SCALE and width // (scale * 2) >= target[0] and height // (scale * 2) >= target[1]:
+            scale *= 2
+        width, height = -(-width // scale), -(-height // scale)
+    pixels = min(width * height, IMAGE_MAX_PIXELS) if IMAGE_MAX_PIXELS else width * height
+    return pixels * bands
+
+# EXIF orientations that swap width and height
+EXIF_ORIENTATION = 0x0112
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+def _normalized(img: Image.Image) -> Image.Image:
+    """
+    Return the decoded image as a viewer shows it: turned upright according
+    to its EXIF orientation, 16-bit greyscale scaled to 8 bits, and
+    transparency flattened onto white. Returns img itself if nothing changes.
+    """
+    if img.getexif().get(EXIF_ORIENTATION, 1) != 1:
+        img = ImageOps.exif_transpose(img)
+    if img.mode.startswith("I"):
+        img = _eight_bit(img)
+    if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+        rgba = img.convert("RGBA")
+        img = Image.new("RGB", rgba.size, "white")
+        img.paste(rgba, mask=rgba.getchannel("A"))
+    elif img.mode == "P":
+        # Palette images would otherwise be resized with nearest-neighbour sampling
+        img = img.convert("RGB")
+    return img
+
+def prepare_image(image_bytes: bytes, policy: PreprocessPolicy = None) -> PreparedImage:
+    """
+    Decode the image once and return the payload to send plus its metadata.
+    The image is downscaled and re-encoded according to `policy`; a re-encode
+    that does not shrink an unresized image is discarded. Images over
+    IMAGE_MAX_PIXELS are downscaled while decoding where the format allows it
+    (JPEG) and rejected with ImageTooLarge otherwise. Raises RuntimeError if the
+    image cannot be decoded.
+    """
+    policy = policy or PREPROCESS_POLICIES[PREPROCESS_POLICY]
     try:
-        with Image.open(io.BytesIO(image_bytes)) as img:
-            format_ = img.format  # Preserve the image format
-            with io.BytesIO() as output:
-                img.save(output, format=format_, quality=quality)
-                logger.info("Image compressed successfully.")
-                return output.getvalue()
+        with Image.open(_image_source(image_bytes)) as img:
+            format_, size, mode = img.format, img.size, img.mode
+            target_size = _scaled_size(size, policy.max_edge)
+            oversized = IMAGE_MAX_PIXELS and size[0] * size[1] > IMAGE_MAX_PIXELS
+            if oversized:
+                target_size = _capped_size(target_size, IMAGE_MAX_PIXELS)
+            resize = target_size != size
+
+            # Let the JPEG decoder do most of the downscaling with DCT scaling
+            if resize and format_ == "JPEG":
+                draft_mode = "RGB" if mode not in ("L", "RGB") else mode
+                if oversized:
+                    # The decoder returns up to twice the requested size per side, so ask
+                    # for a quarter of the cap to keep the decoded image under it
+                    img.draft(draft_mode, _capped_size(target_size, IMAGE_MAX_PIXELS // 4))
+                    target_size = _fitted_size(target_size, img.size)
+                else:
+                    img.draft(draft_mode, target_size)
+            if IMAGE_MAX_PIXELS and img.size[0] * img.size[1] > IMAGE_MAX_PIXELS:
+                raise ImageTooLarge(f"{format_} image of {size[0]}x{size[1]} pixels exceeds the "
+                                    f"{IMAGE_MAX_PIXELS} pixel limit")
+
+            decode_start = time.perf_counter()
+            img.load()  # Full decode, catches truncated or corrupt data
+            observe_stage("decode", time.perf_counter() - decode_start)
+
+            out_format = policy.output_format or (format_ if format_ in LOSSY_FORMATS else None)
+            if resize and not out_format:
+                out_format = "PNG"
+
+            # Whatever is encoded or measured sees the image upright, in 8 bits and without alpha
+            decoded = img
+            if out_format or PRESCREEN_ENABLED or near_duplicates_enabled():
+                if img.getexif().get(EXIF_ORIENTATION, 1) in TRANSPOSED_ORIENTATIONS:
+                    target_size = target_size[::-1]
+                decoded = _normalized(img)
+
+            data, out_size = None, size
+            reduced = decoded
+            if out_format:
+                encode_start = time.perf_counter()
+                try:
+                    out = reduced = (decoded.resize(target_size, Image.LANCZOS)
+                                     if decoded.size != target_size else decoded)
+                    if out_format == "JPEG" and out.mode not in ("L", "RGB"):
+                        out = out.convert("RGB")
+                    with io.BytesIO() as output:
+                        out.save(output, format=out_format, quality=policy.quality)
+                        if resize or output.tell() < len(image_bytes):
+                            data, out_size = output.getvalue(), out.size
+                        else:
+                            out_format = format_
+                except Exception as e:
+                    if resize:
+                        raise
+                    logger.warning(f"Re-encoding image failed, using original bytes: {e}")
+                    out_format = format_
+                observe_stage("encode", time.perf_counter() - encode_start)
+            else:
+                out_format = format_
+            if data is None:
+                # Sending the original; copy it out of the mmap only now
+                data = bytes(image_bytes)
+            # The hash and the statistics only need thumbnails, so take them from the downscaled image
+            image_hash = dhash(reduced) if near_duplicates_enabled() else None
+            stats = None
+            if PRESCREEN_ENABLED:
+                try:
+                    stats = image_stats(reduced)
+                except Exception as e:
+                    logger.warning(f"Image statistics failed, skipping the pre-screen: {e}")
+    except ImageTooLarge as e:
+        logger.error(f"Image rejected: {e}")
+        raise
     except Exception as e:
-        logger.error(f"Error compressing image: {e}")
-        return None
+        logger.error(f"Image validation failed: {e}")
+        raise RuntimeError(f"Invalid image: {e}")
+
+    prepared = PreparedImage(data=data, format=out_format, size=size, mode=mode,
+                             source_bytes=len(image_bytes), sent_size=out_size,
+                             policy_version=policy.version, dhash=image_hash, stats=stats)
+    logger.info(f"Image prepared with policy {policy.version}. Format: {format_} -> {out_format}, "
+                f"Size: {size} -> {out_size}, Mode: {mode}, Bytes saved: {prepared.bytes_saved}")
+    return prepared
 
 def default_json_error(details: str) -> dict:
     """Return a default JSON if something failed."""
@@ -118,210 +416,517 @@ def default_json_error(details: str) -> dict:
         "details": details
     }
 
+def _schema_for(value) -> dict:
+    """JSON schema for a value of the default_json_error layout."""
+    if isinstance(value, bool):
+        return {"type": "boolean"}
+    if isinstance(value, dict):
+        return {
+            "type": "object",
+            "properties": {key: _schema_for(item) for key, item in value.items()},
+            "required": list(value)
+        }
+    return {"type": "string"}
+
+# Response schema for structured output, derived from default_json_error so the two never drift apart
+ANALYSIS_RESPONSE_SCHEMA = _schema_for(default_json_error(""))
+BATCH_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"image": {"type": "integer"}, **ANALYSIS_RESPONSE_SCHEMA["properties"]},
+        "required": ["image"] + ANALYSIS_RESPONSE_SCHEMA["required"]
+    }
+}
+
+# Ask the model for schema-conforming JSON instead of free text
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "true").lower() == "true"
+# Text-only attempts to fix an unparsable response before giving up on the image
+JSON_REPAIR_ATTEMPTS = int(os.getenv("JSON_REPAIR_ATTEMPTS", "1"))
+
+REPAIR_PROMPT = """
+The following response was supposed to be a single JSON object with exactly these fields,
+where every field except "details" is true or false:
+{fields}
+
+Rewrite it as valid JSON with those fields only, keeping the original meaning.
+Respond with the JSON object and nothing else.
+
+Response:
+{text}
+"""
+
+# Parse outcome counters since process start
+PARSE_STATS = {"parsed": 0, "parse_failures": 0, "repaired": 0, "repair_failures": 0}
+
+class AnalysisParseError(ValueError):
+    """The model response could not be turned into a valid analysis."""
+
+def analysis_generation_config(schema: dict = None) -> dict:
+    """generation_config for structured output, or an empty dict when disabled."""
+    if not STRUCTURED_OUTPUT:
+        return {}
+    return {"generation_config": {"response_mime_type": "application/json",
+                                  "response_schema": schema or ANALYSIS_RESPONSE_SCHEMA}}
+
+_BOOLEAN_STRINGS = {"true": True, "yes": True, "false": False, "no": False}
+
+def _validate_against(value, template, path: str):
+    if isinstance(template, bool):
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in _BOOLEAN_STRINGS:
+            return _BOOLEAN_STRINGS[value.strip().lower()]
+        raise AnalysisParseError(f"Field '{path}' is not a boolean: {value!r}")
+    if isinstance(template, dict):
+        if not isinstance(value, dict):
+            raise AnalysisParseError(f"Field '{path or 'response'}' is not an object")
+        result = {}
+        for key, item in template.items():
+            if key not in value:
+                if key == "details":
+                    result[key] = "No details provided."
+                    continue
+                raise AnalysisParseError(f"Missing field '{path + key}'")
+            result[key] = _validate_against(value[key], item, f"{path}{key}.")
+        return result
+    return value if isinstance(value, str) else str(value)
+
+def validate_analysis(data) -> dict:
+    """
+    Check a parsed response against the default_json_error layout.
+    Yes/No style strings are coerced to booleans; anything else wrong raises AnalysisParseError.
+    An optional numeric "confidence" (used by cascade screening) is kept.
+    """
+    analysis = _validate_against(data, default_json_error(""), "")
+    if "confidence" in data:
+        try:
+            analysis["confidence"] = min(1.0, max(0.0, float(data["confidence"])))
+        except (TypeError, ValueError):
+            pass
+    return analysis
+
 # Clean and extract JSON from Gemini response
 def clean_json_response(text: str) -> dict:
-    """Parse JSON from the model's text response."""
+    """
+    Parse and validate JSON from the model's text response.
+    Raises AnalysisParseError instead of guessing a verdict.
+    """
+    text = text.replace('```json', '').replace('```', '').strip()
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end == -1:
+        raise AnalysisParseError("Analysis failed - invalid JSON response.")
     try:
-        text = text.replace('```json', '').replace('```', '').strip()
-        start = text.find('{')
-        end = text.rfind('}')
-        if start != -1 and end != -1:
-            json_str = text[start:end + 1]
-            return json.loads(json_str)
-        else:
-            return {
-                "text_present": False,
-                "text_analysis": {
-                    "has_spelling_errors": False,
-                    "correct_spelling": False
-                },
-                "watermark_present": False,
-                "contains_humans": False,
-                "contains_nudity": False,
-                "contains_blood_violence": False,
-                "contains_brands": False,
-                "copyright_content": False,
-                "recognizable_places": False,
-                "recognizable_people": False,
-                "details": "Analysis failed - invalid JSON response."
-            }
+        return validate_analysis(json.loads(text[start:end + 1]))
     except json.JSONDecodeError as e:
-        logger.error(f"JSON parsing error: {e}")
-        return {
-            "text_present": False,
-            "text_analysis": {
-                "has_spelling_errors": False,
-                "correct_spelling": False
-            },
-            "watermark_present": False,
-            "contains_humans": False,
-            "contains_nudity": False,
-            "contains_blood_violence": False,
-            "contains_brands": False,
-            "copyright_content": False,
-            "recognizable_places": False,
-            "recognizable_people": False,
-            "details": f"Error parsing response: {e}"
-        }
+        raise AnalysisParseError(f"Error parsing response: {e}")
+
+def _repair_contents(text: str) -> list:
+    fields = json.dumps(default_json_error("..."), indent=4)
+    return [REPAIR_PROMPT.format(fields=fields, text=text)]
 
-def validate_image(image_data: bytes) -> bool:
-    """Validate if the image is readable and not corrupted."""
+def _response_text(response) -> str:
+    """Return the response text, turning blocked/empty responses into AnalysisParseError."""
     try:
-        img = Image.open(io.BytesIO(image_data))
-        img.verify()  # Check for corruption
-        logger.info(f"Image validation successful. Format: {img.format}, Size: {img.size}, Mode: {img.mode}")
-        return True
-    except Exception as e:
-        logger.error(f"Image validation failed: {e}")
-        return False
+        return response.text
+    except ValueError as e:
+        raise AnalysisParseError(f"Model returned no text: {e}")
 
-def fetch_image(url: str) -> bytes:
-    """Download image from URL."""
+async def parse_analysis_response_async(response, genai_model) -> dict:
+    """
+    Parse a model response, repairing it with text-only requests if needed.
+    The image is never sent again. Raises AnalysisParseError if repair fails;
+    a fatal model error during repair (e.g. a rejected key) is raised as is.
+    """
+    text = _response_text(response)
+    try:
+        with stage_timer("parse"):
+            analysis = clean_json_response(text)
+        PARSE_STATS["parsed"] += 1
+        return analysis
+    except AnalysisParseError as e:
+        PARSE_STATS["parse_failures"] += 1
+        logger.error(f"Response parse failed, attempting text-only repair: {e}")
+        error = e
+
+    for _ in range(JSON_REPAIR_ATTEMPTS):
+        try:
+            repaired = await genai_model.generate_content_async(contents=_repair_contents(text),
+                                                                **analysis_generation_config())
+            analysis = clean_json_response(_response_text(repaired))
+            PARSE_STATS["repaired"] += 1
+            return analysis
+        except AnalysisParseError as e:
+            error = e
+        except Exception as e:
+            # Retrying cannot fix an auth or invalid-argument failure
+            kind = e.kind if isinstance(e, GeminiRequestError) else classify_error(e)
+            if kind == FATAL:
+                raise
+            error = e
+    PARSE_STATS["repair_failures"] += 1
+    raise AnalysisParseError(f"Unparsable model response: {error}")
+
+def fetch_image(url: str, disk_cache: bool = True) -> bytes:
+    """
+    Download image from URL again, reusing the cached copy only if S3 reports it unchanged.
+    Without disk_cache, the image cache is neither read nor written.
+    """
     try:
-        return download_image(url)
+        if not disk_cache:
+            return get_downloader().fetch(url)
+        return download_image_cached(url, revalidate=True)
     except Exception as e:
         logger.error(f"Failed to download image from URL: {e}")
         raise RuntimeError("Image redownload failed")
 
-# Analyze the image
-def analyze_image(image_bytes: bytes, genai_model, image_url:str="") -> (str, str):
+def prepare_image_or_redownload(image_bytes: bytes, image_url: str = "", policy: PreprocessPolicy = None,
+                                prepare=prepare_image, disk_cache: bool = True) -> PreparedImage:
     """
-    Analyze the image and return (categories, details).
-    If an error occurs, return "error" as a category.
+    Prepare the image, redownloading it once if the bytes we have cannot be decoded.
+    `prepare` does the work, e.g. a process pool's prepare instead of prepare_image.
+    `disk_cache` is passed on to fetch_image.
+    Raises RuntimeError if no usable image could be produced.
     """
-    debug_details = {"initial_validation": None, "compression_attempts": [], "final_status": None}
-    compressed_image_data = None
-    max_compression_attempts = 2
-    attempt = 0
+    try:
+        return prepare(image_bytes, policy)
+    except ImageTooLarge:
+        # The same image would come back; don't download it again
+        raise
+    except RuntimeError:
+        logger.warning("Image could not be decoded. Redownloading image.")
+
+    try:
+        image_bytes = fetch_image(image_url, disk_cache)
+    except RuntimeError as e:
+        raise RuntimeError(f"Image redownload failed: {e}")
 
-    # Validate the initial image
-    debug_details["initial_validation"] = "success" if validate_image(image_bytes) else "failed"
+    try:
+        return prepare(image_bytes, policy)
+    except RuntimeError:
+        logger.error("Redownloaded image is invalid.")
+        raise RuntimeError("Redownloaded image is invalid.")
+
+def prescreen(prepared: PreparedImage):
+    """
+    Return a ('BL', details) verdict for blank, uniform or broken images, or
+    None if the image has to go to the model.
+    """
+    stats = prepared.stats
+    if not PRESCREEN_ENABLED or stats is None:
+        return None
+    PRESCREEN_STATS["screened"] += 1
+
+    if stats.aspect_ratio > PRESCREEN_MAX_ASPECT_RATIO:
+        reason = f"Broken render, aspect ratio {stats.aspect_ratio:.1f}"
+    elif stats.variance < PRESCREEN_MIN_VARIANCE:
+        reason = f"Blank or solid-colour image, variance {stats.variance:.2f}"
+    elif stats.entropy < PRESCREEN_MIN_ENTROPY and stats.edge_density < PRESCREEN_MIN_EDGE_DENSITY:
+        reason = (f"Nearly uniform image, entropy {stats.entropy:.2f} bits, "
+                  f"edge density {stats.edge_density:.4f}")
+    else:
+        return None
 
-    # Try compressing the image
-    while attempt < max_compression_attempts:
+    PRESCREEN_STATS["short_circuited"] += 1
+    return "BL", f"{PRESCREEN_MARKER} {reason}"
+
+def prescreen_report() -> str:
+    """One-line summary of how many model calls the pre-screen saved."""
+    screened, saved = PRESCREEN_STATS["screened"], PRESCREEN_STATS["short_circuited"]
+    rate = saved / screened if screened else 0.0
+    return f"Pre-screen: {screened} images screened, {saved} model calls saved ({rate:.1%})"
+
+def categorize_analysis(analysis: dict) -> (str, str):
+    """Map the parsed model response to (categories, details)."""
+    # Collect categories
+    categories = []
+    if analysis['text_present']:
+        if analysis['text_analysis']['correct_spelling']:
+            categories.append('T1')
+        if analysis['text_analysis']['has_spelling_errors']:
+            categories.append('T2')
+    if analysis['watermark_present']:
+        categories.append('W1')
+    if analysis['contains_humans']:
+        categories.append('H1')
+    if analysis['contains_nudity']:
+        categories.append('N1')
+    if analysis['contains_blood_violence']:
+        categories.append('B1')
+    if analysis['contains_brands']:
+        categories.append('BR')
+    if analysis['copyright_content']:
+        categories.append('CP')
+    if analysis['recognizable_places']:
+        categories.append('PL')
+    if analysis['recognizable_people']:
+        categories.append('PP')
+
+    details_str = analysis.get('details', 'No details provided.')
+
+    # Prioritize categories
+    # Step 1: Filter for pure H1/T1 combinations
+    if set(categories).issubset({'H1', 'T1'}):  # Only H1, T1, or both
+        if 'H1' in categories:
+            return 'H1', details_str  # Prioritize H1
+        elif 'T1' in categories:
+            return 'T1', details_str
+    else:
+        # Step 2: If other categories exist, concatenate them with ', ' and return
+        if categories:
+            return ', '.join(categories), details_str
+
+    # Step 3: If no categories are present, return "good"
+    return "good", details_str
+
+async def request_analysis_async(prepared: PreparedImage, genai_model, prompt: str = ANALYSIS_PROMPT,
+                                 schema: dict = None) -> dict:
+    """Send a prepared image to the model and return the validated analysis dict."""
+    response = await genai_model.generate_content_async(contents=[prompt, prepared.as_part()],
+                                                        **analysis_generation_config(schema))
+    return await parse_analysis_response_async(response, genai_model)
+
+async def analyze_prepared_async(prepared: PreparedImage, genai_model) -> (str, str):
+    """Send a prepared image to the model and return (categories, details)."""
+    try:
+        return categorize_analysis(await request_analysis_async(prepared, genai_model))
+    except AnalysisParseError as e:
+        return "error", str(e)
+    except Exception as e:
+        logger.error(f"Error analyzing image: {e}")
+        return "error", f"Analysis failed: {e}"
+
+def _parse_thresholds(value: str) -> dict:
+    """Parse "T2:0.9,W1:0.85" into {"T2": 0.9, "W1": 0.85}."""
+    thresholds = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        code, _, threshold = entry.partition(":")
+        thresholds[code.strip()] = float(threshold)
+    return thresholds
+
+# Two-tier model cascade: a cheap model screens, uncertain or sensitive images go to the strong model
+CASCADE_ENABLED = os.getenv("CASCADE_ENABLED", "false").lower() == "true"
+CASCADE_SCREEN_MODEL = os.getenv("CASCADE_SCREEN_MODEL", "gemini-1.5-flash-8b")
+# Categories that are always confirmed by the strong model when the screen flags them
+CASCADE_ESCALATE_CATEGORIES = set(filter(None, os.getenv("CASCADE_ESCALATE_CATEGORIES", "N1,B1,PP,CP").split(",")))
+# Minimum screening confidence to accept a verdict, with optional per-category overrides
+CASCADE_MIN_CONFIDENCE = float(os.getenv("CASCADE_MIN_CONFIDENCE", "0.8"))
+CASCADE_CATEGORY_CONFIDENCE = _parse_thresholds(os.getenv("CASCADE_CATEGORY_CONFIDENCE", ""))
+
+SCREEN_PROMPT = ANALYSIS_PROMPT + """
+Also include "confidence": a number between 0 and 1 saying how certain you are of the whole answer.
+"""
+SCREEN_RESPONSE_SCHEMA = {
+    **ANALYSIS_RESPONSE_SCHEMA,
+    "properties": {**ANALYSIS_RESPONSE_SCHEMA["properties"], "confidence": {"type": "number"}},
+    "required": ANALYSIS_RESPONSE_SCHEMA["required"] + ["confidence"]
+}
+
+class ModelCascade:
+    """
+    Screen every image with a cheaper model and escalate to the strong model
+    only when the screen flags an escalation category, reports a confidence
+    below the threshold for what it found, or fails.
+    """
+
+    def __init__(self, screen_model, strong_model, escalate_categories: set = None,
+                 min_confidence: float = None, category_confidence: dict = None):
+        self.screen_model = screen_model
+        self.strong_model = strong_model
+        self.escalate_categories = CASCADE_ESCALATE_CATEGORIES if escalate_categories is None else escalate_categories
+        self.min_confidence = CASCADE_MIN_CONFIDENCE if min_confidence is None else min_confidence
+        self.category_confidence = CASCADE_CATEGORY_CONFIDENCE if category_confidence is None else category_confidence
+        self.stats = {"screened": 0, "escalated": 0, "screen_errors": 0}
+
+    @property
+    def model_name(self) -> str:
+        """Identifies the cascade configuration, e.g. for result cache keys."""
+        return f"{self.screen_model.model_name}>{self.strong_model.model_name}"
+
+    @property
+    def escalation_rate(self) -> float:
+        return self.stats["escalated"] / self.stats["screened"] if self.stats["screened"] else 0.0
+
+    def needs_escalation(self, categories: str, confidence: float) -> bool:
+        """Decide whether a screening verdict must be confirmed by the strong model."""
+        codes = set(categories.split(", ")) - {"good"}
+        if codes & self.escalate_categories:
+            return True
+        threshold = max([self.category_confidence.get(code, self.min_confidence) for code in codes]
+                        or [self.min_confidence])
+        return confidence < threshold
+
+    def _screened(self, analysis: dict):
+        """Return the screening verdict, or None if it has to be escalated."""
+        self.stats["screened"] += 1
+        categories, details = categorize_analysis(analysis)
+        confidence = analysis.get("confidence", 0.0)
+        if not self.needs_escalation(categories, confidence):
+            return categories, details
+        self.stats["escalated"] += 1
+        logger.info(f"Escalating image to {self.strong_model.model_name}: screen={categories}, "
+                    f"confidence={confidence:.2f}, escalation rate={self.escalation_rate:.1%}")
+        return None
+
+    async def analyze_async(self, prepared: PreparedImage) -> (str, str):
         try:
-            compressed_image_data = compress_image(image_bytes)
-            if compressed_image_data:
-                if attempt != 1:
-                    logger.info(f"Image compression succeeded on attempt {attempt + 1}.")
-                debug_details["compression_attempts"].append(f"Success on attempt {attempt + 1}")
-                break
+            analysis = await request_analysis_async(prepared, self.screen_model, SCREEN_PROMPT,
+                                                    SCREEN_RESPONSE_SCHEMA)
+            verdict = self._screened(analysis)
+            if verdict:
+                return verdict
         except Exception as e:
-            logger.error(f"Image compression failed on attempt {attempt + 1}: {e}")
-            debug_details["compression_attempts"].append(f"Failed on attempt {attempt + 1}: {e}")
-        attempt += 1
+            self.stats["screen_errors"] += 1
+            logger.error(f"Screening failed, escalating: {e}")
+        return await analyze_prepared_async(prepared, self.strong_model)
 
-    # If compression failed, attempt to redownload and compress again
-    if not compressed_image_data:
-        logger.warning("Image compression failed after multiple attempts. Redownloading image.")
+def parse_batch_response(text: str, count: int) -> list:
+    """
+    Parse a multi-image response into `count` (categories, details) tuples.
+    Entries that are missing or malformed are None so the caller can retry them alone.
+    """
+    results = [None] * count
+    text = text.replace('```json', '').replace('```', '').strip()
+    start = text.find('[')
+    end = text.rfind(']')
+    if start == -1 or end == -1:
+        logger.error("Batch response did not contain a JSON array.")
+        return results
+    try:
+        entries = json.loads(text[start:end + 1])
+    except json.JSONDecodeError as e:
+        logger.error(f"Batch JSON parsing error: {e}")
+        return results
+    if not isinstance(entries, list):
+        return results
+
+    for position, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            continue
+        index = entry.get("image", position + 1)
+        if not isinstance(index, int) or not 1 <= index <= count or results[index - 1] is not None:
+            continue
         try:
-            image_bytes = fetch_image(image_url)
-            if validate_image(image_bytes):
-                compressed_image_data = compress_image(image_bytes)
-                if compressed_image_data:
-                    logger.info("Image compression succeeded after redownload.")
-                    debug_details["compression_attempts"].append("Success after redownload")
-                else:
-                    logger.error("Image compression failed after redownload.")
-                    debug_details["compression_attempts"].append("Failed after redownload")
-            else:
-                logger.error("Redownloaded image is invalid.")
-                debug_details["final_status"] = "Redownloaded image invalid"
-                return "error", "Redownloaded image is invalid."
-        except RuntimeError as e:
-            debug_details["final_status"] = f"Image redownload failed: {e}"
-            return "error", f"Image redownload failed: {e}"
-
-    # If compression still failed, use original image bytes
-    if not compressed_image_data:
-        logger.warning("Proceeding with original image bytes after all compression attempts failed.")
-        compressed_image_data = image_bytes
-        debug_details["final_status"] = "Using original image bytes"
-
-
-    image = {
-        'mime_type': f'image/{Image.open(io.BytesIO(compressed_image_data)).format.lower()}',
-        'data': compressed_image_data
-    }
-
-    max_retries = 3
-    retry_count = 0
+            results[index - 1] = categorize_analysis(validate_analysis(entry))
+        except AnalysisParseError as e:
+            PARSE_STATS["parse_failures"] += 1
+            logger.error(f"Batch entry for image {index} is invalid: {e}")
+    return results
 
-    while retry_count < max_retries:
-        try:
-            # Send the image to the model for analysis
-            response = genai_model.generate_content(contents=[ANALYSIS_PROMPT, image])
-            analysis = clean_json_response(response.text)
-
-            # Collect categories
-            categories = []
-            if analysis['text_present']:
-                if analysis['text_analysis']['correct_spelling']:
-                    categories.append('T1')
-                if analysis['text_analysis']['has_spelling_errors']:
-                    categories.append('T2')
-            if analysis['watermark_present']:
-                categories.append('W1')
-            if analysis['contains_humans']:
-                categories.append('H1')
-            if analysis['contains_nudity']:
-                categories.append('N1')
-            if analysis['contains_blood_violence']:
-                categories.append('B1')
-            if analysis['contains_brands']:
-                categories.append('BR')
-            if analysis['copyright_content']:
-                categories.append('CP')
-            if analysis['recognizable_places']:
-                categories.append('PL')
-            if analysis['recognizable_people']:
-                categories.append('PP')
-
-            details_str = analysis.get('details', 'No details provided.')
-
-            # Prioritize categories
-            # Step 1: Filter for pure H1/T1 combinations
-            if set(categories).issubset({'H1', 'T1'}):  # Only H1, T1, or both
-                if 'H1' in categories:
-                    return 'H1', details_str  # Prioritize H1
-                elif 'T1' in categories:
-                    return 'T1', details_str
-            else:
-                # Step 2: If other categories exist, concatenate them with ', ' and return
-                if categories:
-                    return ', '.join(categories), details_str
+async def analyze_prepared_batch_async(prepared_images: list, genai_model) -> list:
+    """
+    Analyze several prepared images in one request.
+    Returns one (categories, details) tuple per image, or None where the
+    response could not be mapped back to that image.
+    """
+    contents = [BATCH_ANALYSIS_PROMPT.format(count=len(prepared_images))]
+    for number, prepared in enumerate(prepared_images, start=1):
+        contents.extend([f"Image {number}", prepared.as_part()])
+    try:
+        response = await genai_model.generate_content_async(contents=contents,
+                                                            **analysis_generation_config(BATCH_RESPONSE_SCHEMA))
+        return parse_batch_response(response.text, len(prepared_images))
+    except Exception as e:
+        logger.error(f"Error analyzing image batch: {e}")
+        return [None] * len(prepared_images)
 
-            # Step 3: If no categories are present, return "good"
-            return "good", details_str
+class AnalysisBatcher:
+    """
+    Collects prepared images from concurrent callers and sends them to the
+    model `batch_size` at a time. A batch is sent when full or after `linger`
+    seconds. Images whose batch result cannot be parsed fall back to a
+    single-image call, and `parity_rate` of batched images are re-checked alone.
+    With a cascade, images are not batched: the batch prompt reports no
+    confidence to decide escalation on, so every image goes through the cascade.
+    """
 
+    def __init__(self, genai_model, batch_size: int = ANALYSIS_BATCH_SIZE,
+                 linger: float = ANALYSIS_BATCH_LINGER, parity_rate: float = ANALYSIS_BATCH_PARITY_RATE,
+                 cascade: ModelCascade = None):
+        self.genai_model = genai_model
+        self.cascade = cascade
+        if cascade and batch_size > 1:
+            logger.warning(f"ANALYSIS_BATCH_SIZE={batch_size} is ignored while the cascade is enabled; "
+                           f"images are screened one at a time.")
+            batch_size = 1
+        self.batch_size = batch_size
+        self.linger = linger
+        self.parity_rate = parity_rate
+        self.stats = {"requests": 0, "batched_images": 0, "fallbacks": 0,
+                      "parity_checked": 0, "parity_mismatches": 0}
+        self._pending = []
+        self._timer = None
+        # The event loop only keeps weak references to tasks
+        self._batches = set()
+
+    async def analyze_single(self, prepared: PreparedImage) -> (str, str):
+        """Analyze one image on its own, through the cascade when configured."""
+        if self.cascade:
+            return await self.cascade.analyze_async(prepared)
+        return await analyze_prepared_async(prepared, self.genai_model)
+
+    async def analyze(self, prepared: PreparedImage) -> (str, str):
+        """Analyze one prepared image, batched with others when enabled."""
+        if self.batch_size <= 1:
+            return await self.analyze_single(prepared)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((prepared, future))
+        if len(self._pending) >= self.batch_size:
+            self._send_pending()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.linger, self._send_pending)
+        return await future
+
+    def _send_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+        if batch:
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+        if self._pending:
+            self._timer = asyncio.get_running_loop().call_later(self.linger, self._send_pending)
+
+    async def _run_batch(self, batch: list):
+        try:
+            prepared_images = [prepared for prepared, _ in batch]
+            self.stats["requests"] += 1
+            self.stats["batched_images"] += len(batch)
+            results = await analyze_prepared_batch_async(prepared_images, self.genai_model)
+            await asyncio.gather(*(self._resolve(prepared, future, result)
+                                   for (prepared, future), result in zip(batch, results)))
         except Exception as e:
-            logger.error(f"Error analyzing image: {e}")
-            retry_count += 1
-            if retry_count >= max_retries:
-                return "error", f"Failed after {max_retries} retries: {e}"
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _resolve(self, prepared: PreparedImage, future, result):
+        if result is None:
+            self.stats["fallbacks"] += 1
+            result = await self.analyze_single(prepared)
+        elif random.random() < self.parity_rate:
+            single = await analyze_prepared_async(prepared, self.genai_model)
+            self.stats["parity_checked"] += 1
+            if single[0] != result[0]:
+                self.stats["parity_mismatches"] += 1
+                logger.warning(f"Batch parity mismatch: batched={result[0]}, single={single[0]}")
+            result = single
+        if not future.done():
+            future.set_result(result)
 
 
 # Example usage
 if __name__ == "__main__":
-    from dotenv import load_dotenv
-    import os
-    import google.generativeai as genai
-
-    load_dotenv()
+    from gemini_utils import configure_gemini, GeminiClient
 
     gemini_api_key = os.getenv("GEMINI_API_KEY", None)
 
-    def configure_gemini(api_key: str):
-        """Configure the generative AI model."""
-        genai.configure(api_key=api_key)
-
-        # Gemini model configuration
-        model = genai.GenerativeModel('gemini-2.0-flash')
-
-        return model
-
     # Configure Gemini with an API key
-    genai_model  = configure_gemini(gemini_api_key)
+    genai_model  = GeminiClient(configure_gemini(gemini_api_key, 'gemini-2.0-flash'))
 
     # response = genai_model.generate_content(contents=[ANALYSIS_PROMPT])
     #
@@ -332,7 +937,7 @@ if __name__ == "__main__":
         image_bytes = image_file.read()
 
     # Analyze the image using bytes
-    categories, details = analyze_image(image_bytes, genai_model)
+    categories, details = asyncio.run(analyze_prepared_async(prepare_image(image_bytes), genai_model))
     logger.info(f"Categories: {categories}")
     logger.info(f"Details: {details}")
 
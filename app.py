@@ -1,149 +1,563 @@
-from fastapi import FastAPI, HTTPException
-from analysis_utils import download_image, analyze_image
-from supabase_utils import update_auto_review_results, get_images_with_status
-from logging_config import logger
+import contextvars
+import json
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from fastapi import FastAPI, HTTPException, Path, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from analysis_utils import (decoded_size, prepare_image, prepare_image_or_redownload,
+                            select_preprocess_policy, prescreen, AnalysisBatcher, ModelCascade, PreparedImage,
+                            CASCADE_ENABLED, CASCADE_SCREEN_MODEL, PARSE_STATS, PRESCREEN_STATS)
+from cache_utils import get_result_cache, result_cache_key
+from dedup_utils import NEAR_DUP_MODE, get_near_duplicate_index, inherited_details
+from download_utils import get_downloader
+from image_cache_utils import download_image_cached_async, get_image_cache
+from gemini_utils import configure_gemini, GeminiClient
+from supabase_utils import (get_images_with_status, get_image_record_by_job, get_result_writer, renew_leases,
+                            reap_expired_leases, LEASE_SECONDS)
+from logging_config import logger, trace_id
+from metrics_utils import (BYTES_IN_FLIGHT, CACHE_BYTES, CACHE_ENTRIES, QUEUE_WAIT, RESULT_WRITES_PENDING, stage_timer,
+                           count_result, count_error, register_stats)
+from memory_utils import MemoryBudget
+from pool_utils import get_prepare_pool
+from replay_utils import ReplayModel, with_replay
+from scheduler_utils import fair_order, priority_class
 import os
 from dotenv import load_dotenv
-import google.generativeai as genai
 
 load_dotenv()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Make sure buffered results reach the database before exiting
+    get_result_writer().close()
+    prepare_pool = get_prepare_pool()
+    if prepare_pool:
+        prepare_pool.close()
+
+app = FastAPI(lifespan=lifespan)
 
 gemini_api_key = os.getenv("GEMINI_API_KEY", None)
 if not gemini_api_key:
     raise EnvironmentError("GEMINI_API_KEY not found in environment variables.")
 
-def configure_gemini(api_key: str):
-    """Configure the generative AI model."""
-    genai.configure(api_key=api_key)
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+# Seconds a successful key check is trusted before the next one calls the model (0 = check every time)
+GEMINI_KEY_CHECK_TTL = float(os.getenv("GEMINI_KEY_CHECK_TTL", "600"))
+
+# Configure Gemini with an API key; all model calls go through the rate-limited, retrying client
+genai_model  = with_replay(GeminiClient(configure_gemini(gemini_api_key, GEMINI_MODEL)))
+
+# Cheap screening model in front of genai_model when CASCADE_ENABLED is set
+cascade = ModelCascade(with_replay(GeminiClient(configure_gemini(gemini_api_key, CASCADE_SCREEN_MODEL))),
+                       genai_model) if CASCADE_ENABLED else None
+
+# Packs concurrent images into multi-image requests when ANALYSIS_BATCH_SIZE > 1
+analysis_batcher = AnalysisBatcher(genai_model, cascade=cascade)
+
+# Component stats exported on /metrics
+register_stats("gemini_calls", genai_model.stats, "Gemini calls, retries and failures by kind.")
+register_stats("parse", PARSE_STATS, "Model response parsing and repair outcomes.")
+register_stats("prescreen", PRESCREEN_STATS, "Images pre-screened locally and model calls saved.")
+register_stats("batcher", analysis_batcher.stats, "Multi-image batching requests, fallbacks and parity checks.")
+if cascade:
+    register_stats("cascade", cascade.stats, "Cascade screening and escalations.")
+if isinstance(genai_model, ReplayModel):
+    register_stats("gemini_replay", genai_model.replay_stats, "Gemini responses recorded, replayed and missing.")
+
+def result_cache_stats() -> dict:
+    result_cache = get_result_cache()
+    return {"hits": result_cache.hits, "misses": result_cache.misses} if result_cache else {}
+
+register_stats("result_cache", result_cache_stats, "Result cache lookups.")
 
-    # Gemini model configuration
-    model = genai.GenerativeModel('gemini-1.5-flash')
+def result_cache_size(field: str) -> int:
+    result_cache = get_result_cache()
+    return result_cache.stats()[field] if result_cache else 0
 
-    return model
+CACHE_ENTRIES.labels("result").set_function(lambda: result_cache_size("entries"))
+CACHE_BYTES.labels("result").set_function(lambda: result_cache_size("bytes"))
 
-# Configure Gemini with an API key
-genai_model  = configure_gemini(gemini_api_key)
+def image_cache_stats() -> dict:
+    image_cache = get_image_cache()
+    return image_cache.counters() if image_cache else {}
+
+register_stats("image_cache", image_cache_stats, "Source image cache hits, misses, 304s and bytes not downloaded.")
+
+def image_cache_size(field: str) -> int:
+    image_cache = get_image_cache()
+    return image_cache.report()[field] if image_cache else 0
+
+CACHE_ENTRIES.labels("image").set_function(lambda: image_cache_size("entries"))
+CACHE_BYTES.labels("image").set_function(lambda: image_cache_size("bytes"))
 
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 
-executor = ThreadPoolExecutor()
+# Maximum number of images being downloaded/analyzed at the same time
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "8"))
+
+executor = ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT + 4)
+in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+# Most (job_id, image_index) pairs accepted by one POST /auto_review call
+AUTO_REVIEW_MAX_IMAGES = int(os.getenv("AUTO_REVIEW_MAX_IMAGES", "100"))
+# Debugging aid: save each /auto_review image in this directory (empty = never write to disk)
+AUTO_REVIEW_DEBUG_DIR = os.getenv("AUTO_REVIEW_DEBUG_DIR", "")
+
+# Caps the image bytes held at once; downloads wait when it is used up
+memory_budget = MemoryBudget()
+BYTES_IN_FLIGHT.set_function(lambda: memory_budget.in_use)
+RESULT_WRITES_PENDING.set_function(lambda: get_result_writer().pending())
 
 BASE_URL = "https://imagereviewyataura.s3.us-east-1.amazonaws.com"
+# job_id from a request ends up in S3 keys and debug file names, so no slashes or dots
+JOB_ID_PATTERN = r"^[A-Za-z0-9_-]+$"
 
 def construct_image_url(job_id: str, image_index: int) -> str:
     """Construct the image URL from job_id and image_index."""
     return f"{BASE_URL}/{job_id}__{image_index}.jpg"
 
+# model_name -> time.monotonic() until which the last successful key check holds
+key_checked_until = {}
+
 def validate_gemini_api_key(model):
-    """Validate the Gemini API key by making a test request."""
+    """
+    Validate the Gemini API key by making a test request, at most once per GEMINI_KEY_CHECK_TTL.
+
+    The check makes a single attempt so a bad or rate-limited key fails fast
+    instead of waiting out the retry schedule.
+    """
+    if getattr(model, "mode", None) == "replay":
+        # Replayed responses never reach the API
+        return
+    if time.monotonic() < key_checked_until.get(model.model_name, 0):
+        return
     try:
         test_prompt = "Test API Key Validity"
-        model.generate_content(contents=[test_prompt])
+        # Call the client directly so a recording ReplayModel doesn't store the check
+        client = getattr(model, "client", model)
+        client.generate_content(contents=[test_prompt], max_retries=0)
+        key_checked_until[model.model_name] = time.monotonic() + GEMINI_KEY_CHECK_TTL
         logger.info("Gemini API key is valid.")
     except Exception as e:
         error_message = f"Gemini API key validation failed: {e}"
         logger.error(error_message)
         raise HTTPException(status_code=500, detail=error_message)
 
-
-@app.post("/auto_review/{job_id}/{image_index}")
-def auto_review(job_id: str, image_index: int):
-    """
-    Retrieve the record from the database, construct the image URL, download and analyze the image,
-    update the record with analysis results.
-    """
-    # Construct the image URL
-    image_url = construct_image_url(job_id, image_index)
-    print(f"Constructed Image URL: {image_url}")
-
+def lookup_cached_result(image_bytes: bytes, policy):
+    """Return (cache_key, cached (categories, details) or None) for the image."""
+    result_cache = get_result_cache()
+    if result_cache is None:
+        return None, None
+    model_name = cascade.model_name if cascade else genai_model.model_name
+    cache_key = result_cache_key(image_bytes, model_name, policy.version)
+    with stage_timer("cache"):
+        return cache_key, result_cache.get(cache_key)
+
+def store_cached_result(cache_key: str, category: str, details: str):
+    """Cache a successful analysis result."""
+    result_cache = get_result_cache()
+    if result_cache is not None and cache_key and category != "error":
+        result_cache.put(cache_key, category, details)
+
+
+@app.get("/health")
+async def health():
+    """Liveness plus the (cached) Gemini key check; 503 if the key is not usable."""
     try:
-        # 1. Download
-        image_bytes = download_image(image_url)
-
-        # Save the image to a file
-        with open("image.png", "wb") as file:
-            file.write(image_bytes)
-
-        print("Image downloaded and saved as 'image.png'.")
-
-        # 2. Analyze
-        category_str, details_str = analyze_image(image_bytes, genai_model=genai_model)
+        await asyncio.get_running_loop().run_in_executor(executor, validate_gemini_api_key, genai_model)
+    except HTTPException as e:
+        raise HTTPException(status_code=503, detail=e.detail)
+    return {"status": "ok", "model": genai_model.model_name}
 
-        return {"message": "Auto review success", "categories": category_str, "details": details_str}
 
-    except Exception as e:
-        logger.exception("Error in auto_review endpoint")
-        raise HTTPException(status_code=500, detail=str(e))
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics: stage latencies, results, errors and component counters."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
-async def async_download_image(url: str) -> bytes:
-    """Asynchronous wrapper for the pycurl-based download_image function."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, download_image, url)
+async def async_download_image(url: str, disk_cache: bool = True) -> bytes:
+    """
+    Download through the image cache and the shared CurlMulti downloader without blocking the event loop.
+    Without disk_cache the image is downloaded straight into memory.
+    """
+    with stage_timer("download"):
+        if not disk_cache:
+            return await asyncio.wrap_future(get_downloader().submit(url))
+        return await download_image_cached_async(url)
+
+def record_auto_review_result(image_id: str, category: str, details: str):
+    """Queue the analysis result for a record on the write-behind buffer."""
+    count_result(category)
+    if category == "error":
+        get_result_writer().add(image_id, "auto_review_error", "auto_review_error", details)
+    else:
+        get_result_writer().add(image_id, category, "auto_review_success", details)
+
+@dataclass
+class ReviewItem:
+    """One image moving through the review stages."""
+    image_id: str
+    job_id: str
+    image_url: str
+    image_bytes: bytes = None
+    prepared: PreparedImage = None
+    cache_key: str = None
+    duplicate: tuple = None
+    category: str = None
+    details: str = None
+    info: dict = field(default_factory=dict)
+    started: float = field(default_factory=time.perf_counter)
+    reserved: int = 0
+    # False keeps the item out of the on-disk image and result caches
+    disk_cache: bool = True
+
+    @property
+    def done(self) -> bool:
+        """True once a verdict has been reached."""
+        return self.category is not None
+
+async def download_item(item: ReviewItem):
+    """Wait for room in the memory budget, then download the image into the item."""
+    item.reserved = await memory_budget.reserve()
+    try:
+        item.image_bytes = await async_download_image(item.image_url, item.disk_cache)
+    except Exception:
+        count_error("download")
+        raise
+    item.reserved = await memory_budget.resize(item.reserved, len(item.image_bytes), observed=True)
+
+async def release_item(item: ReviewItem):
+    """Drop the image data of a finished item and give its bytes back to the budget."""
+    item.image_bytes = item.prepared = None
+    await memory_budget.release(item.reserved)
+    item.reserved = 0
+
+async def prepare_item(item: ReviewItem):
+    """
+    Result cache, preparation, pre-screen and near-duplicate stages for a downloaded image.
+    Sets the verdict on the item when no model call is needed.
+    """
+    policy = select_preprocess_policy(item.job_id)
+    item.info.update({"preprocess_policy": policy.version, "cached": False})
+
+    # Hashing the image and the SQLite lookup would block the event loop
+    loop = asyncio.get_running_loop()
+    cached = None
+    if item.disk_cache:
+        item.cache_key, cached = await loop.run_in_executor(executor, lookup_cached_result, item.image_bytes, policy)
+    if cached:
+        item.info["cached"] = True
+        item.category, item.details = cached
+        return
+
+    # Run in a copy of the current context so the preparation logs carry the trace id
+    prepare_pool = get_prepare_pool()
+    prepare = prepare_pool.prepare if prepare_pool else prepare_image
+    try:
+        # The decoded bitmap is far larger than the download; reserve it while preparing
+        async with memory_budget.hold(decoded_size(item.image_bytes, policy)):
+            with stage_timer("prepare"):
+                item.prepared = await loop.run_in_executor(executor, contextvars.copy_context().run,
+                                                           prepare_image_or_redownload, item.image_bytes,
+                                                           item.image_url, policy, prepare, item.disk_cache)
+    except RuntimeError as e:
+        count_error("prepare")
+        item.category, item.details = "error", str(e)
+        return
+
+    # Only the prepared payload is needed from here on
+    item.image_bytes = None
+    item.reserved = await memory_budget.resize(item.reserved, len(item.prepared.data))
+
+    verdict = prescreen(item.prepared)
+    if verdict:
+        item.info["prescreened"] = True
+        item.category, item.details = verdict
+        return
+
+    near_duplicates = get_near_duplicate_index()
+    item.duplicate = near_duplicates.find(item.prepared.dhash, item.job_id) if near_duplicates else None
+    if item.duplicate and NEAR_DUP_MODE == "reuse":
+        reviewed, distance = item.duplicate
+        item.info["inherited_from"] = reviewed.image_id
+        logger.info(f"Image {item.image_id} inherits verdict of {reviewed.image_id} (distance {distance}).")
+        item.category, item.details = reviewed.category, inherited_details(reviewed, distance)
+
+async def analyze_item(item: ReviewItem):
+    """Model stage: analyze the prepared image and remember the verdict."""
+    with stage_timer("analyze"):
+        item.category, item.details = await analysis_batcher.analyze(item.prepared)
+    if item.category == "error":
+        count_error("analyze")
+    if item.disk_cache:
+        await asyncio.get_running_loop().run_in_executor(executor, store_cached_result,
+                                                         item.cache_key, item.category, item.details)
+
+    near_duplicates = get_near_duplicate_index()
+    if near_duplicates and item.category != "error":
+        if item.duplicate:
+            reviewed, distance = item.duplicate
+            logger.info(f"Near-duplicate shadow check for {item.image_id}: inherited={reviewed.category}, "
+                        f"model={item.category}, distance={distance}, match={reviewed.category == item.category}")
+        near_duplicates.add(item.prepared.dhash, item.job_id, item.image_id, item.category, item.details)
+
+async def review_item(item: ReviewItem):
+    """
+    Produce the verdict for one downloaded image: result cache, preparation,
+    near-duplicate lookup and finally the model call.
+    Sets category, details and info (how the verdict was reached) on the item.
+    """
+    await prepare_item(item)
+    if not item.done:
+        await analyze_item(item)
 
 async def process_record(record):
     """Download and process a single image."""
+    queued = time.perf_counter()
+    async with in_flight:
+        QUEUE_WAIT.labels(priority_class(record)).observe(time.perf_counter() - queued)
+        trace_id.set(record["id"])
+        with stage_timer("total"):
+            # Construct the URL
+            item = ReviewItem(image_id=record["id"], job_id=record["job_id"],
+                              image_url=construct_image_url(record["job_id"], record["image_index"]))
+            try:
+                # Download the image, waiting for room in the memory budget
+                await download_item(item)
+
+                # Process the image (analyze it)
+                await review_item(item)
+
+                # Update the database based on the analysis result
+                record_auto_review_result(item.image_id, item.category, item.details)
+                if item.category == "error":
+                    return {"image_id": item.image_id, "status": "error", "error": item.details, **item.info}
+                else:
+                    return {"image_id": item.image_id, "status": "success", "categories": item.category,
+                            "details": item.details, **item.info}
+
+            except Exception as e:
+                # Handle errors and update the database with the error
+                record_auto_review_result(item.image_id, "error", str(e))
+                return {"image_id": item.image_id, "status": "error", "error": str(e)}
+            finally:
+                await release_item(item)
+
+# (job_id, image_index) -> task reviewing it, shared by concurrent /auto_review requests
+auto_review_flights = {}
+
+def save_debug_image(job_id: str, image_index: int, image_bytes: bytes):
+    """Write the downloaded image to AUTO_REVIEW_DEBUG_DIR under a per-image name."""
+    os.makedirs(AUTO_REVIEW_DEBUG_DIR, exist_ok=True)
+    with open(os.path.join(AUTO_REVIEW_DEBUG_DIR, f"{job_id}__{image_index}.jpg"), "wb") as file:
+        file.write(image_bytes)
+
+async def find_record(job_id: str, image_index: int):
+    """Fetch the image's record without blocking the event loop; None if missing or unavailable."""
     try:
-        # Construct the URL
-        job_id = record["job_id"]
-        image_index = record["image_index"]
-        url = f"https://imagereviewyataura.s3.us-east-1.amazonaws.com/{job_id}__{image_index}.jpg"
-
-        # Download the image
-        image_bytes = await async_download_image(url)
-
-        # Process the image (analyze it)
-        category, details = analyze_image(image_bytes, genai_model=genai_model)
-
-        # Update the database based on the analysis result
-        if category == "error":
-            update_auto_review_results(
-                image_id=record["id"],
-                auto_review_status="auto_review_error",
-                review_status="auto_review_error",
-                auto_review_details=details
-            )
-            return {"image_id": record["id"], "status": "error", "error": details}
-        else:
-            update_auto_review_results(
-                image_id=record["id"],
-                auto_review_status=category,
-                review_status="auto_review_success",
-                auto_review_details=details
-            )
-            return {"image_id": record["id"], "status": "success", "categories": category, "details": details}
-
+        return await asyncio.get_running_loop().run_in_executor(executor, get_image_record_by_job,
+                                                                job_id, image_index)
     except Exception as e:
-        # Handle errors and update the database with the error
-        update_auto_review_results(
-            image_id=record["id"],
-            auto_review_status="auto_review_error",
-            review_status="auto_review_error",
-            auto_review_details=str(e)
-        )
-        return {"image_id": record["id"], "status": "error", "error": str(e)}
+        logger.error(f"Record lookup for {job_id}/{image_index} failed: {e}")
+        return None
+
+async def review_by_job(job_id: str, image_index: int) -> dict:
+    """Look up, download, review and record one image addressed by job and index."""
+    async with in_flight:
+        trace_id.set(f"{job_id}/{image_index}")
+        with stage_timer("total"):
+            # The record is only needed for the write-back, so fetch it while downloading
+            record_lookup = asyncio.create_task(find_record(job_id, image_index))
+            # Nothing is read from or written to disk for this endpoint, the image and result caches included
+            item = ReviewItem(image_id=None, job_id=job_id, image_url=construct_image_url(job_id, image_index),
+                              disk_cache=False)
+            result = {"job_id": job_id, "image_index": image_index}
+            try:
+                await download_item(item)
+                if AUTO_REVIEW_DEBUG_DIR:
+                    await asyncio.get_running_loop().run_in_executor(executor, save_debug_image,
+                                                                     job_id, image_index, item.image_bytes)
+                record = await record_lookup
+                item.image_id = record["id"] if record else None
+                await review_item(item)
+                result.update({"status": "success" if item.category != "error" else "error",
+                               "categories": item.category, "details": item.details, **item.info})
+            except Exception as e:
+                logger.exception(f"Auto review of {job_id}/{image_index} failed")
+                item.category, item.details = "error", str(e)
+                result.update({"status": "error", "error": str(e)})
+            finally:
+                await release_item(item)
+
+            record = await record_lookup
+            if record:
+                record_auto_review_result(record["id"], item.category, item.details)
+            else:
+                logger.warning(f"No record found for {job_id}/{image_index}; result not saved.")
+            return result
+
+async def review_by_job_once(job_id: str, image_index: int) -> dict:
+    """
+    Single-flight wrapper around review_by_job: concurrent requests for the same
+    image wait for the one review already in progress instead of starting another.
+    """
+    key = (job_id, image_index)
+    flight = auto_review_flights.get(key)
+    if flight is None:
+        flight = asyncio.create_task(review_by_job(job_id, image_index))
+        auto_review_flights[key] = flight
+        flight.add_done_callback(lambda _: auto_review_flights.pop(key, None))
+    else:
+        logger.info(f"Joining the review of {job_id}/{image_index} already in progress.")
+    # A disconnecting client must not cancel a review other requests are waiting on
+    return await asyncio.shield(flight)
+
+
+class ImageRef(BaseModel):
+    job_id: str = Field(pattern=JOB_ID_PATTERN)
+    image_index: int = Field(ge=0)
+
+class AutoReviewRequest(BaseModel):
+    images: list[ImageRef]
+
+@app.post("/auto_review")
+async def auto_review_batch(request: AutoReviewRequest):
+    """
+    Review several images, given as (job_id, image_index) pairs, and update their records.
+    Results are returned in request order; one failing image does not fail the others.
+    """
+    if len(request.images) > AUTO_REVIEW_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {AUTO_REVIEW_MAX_IMAGES} images per request.")
+    results = await asyncio.gather(*(review_by_job_once(image.job_id, image.image_index)
+                                     for image in request.images))
+    return {"message": "Auto review completed.", "results": results}
 
+@app.post("/auto_review/{job_id}/{image_index}")
+async def auto_review(job_id: str = Path(pattern=JOB_ID_PATTERN), image_index: int = Path(ge=0)):
+    """
+    Retrieve the record from the database, construct the image URL, download and analyze the image,
+    update the record with analysis results.
+    """
+    result = await review_by_job_once(job_id, image_index)
+    if "error" in result:
+        raise HTTPException(status_code=500, detail=result["error"])
+    return {"message": "Auto review success", **result}
+
+async def heartbeat_leases(image_ids: list, stop: asyncio.Event):
+    """Renew the leases on claimed images until `stop` is set."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=LEASE_SECONDS / 3)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await loop.run_in_executor(executor, renew_leases, image_ids)
+        except Exception as e:
+            logger.error(f"Lease heartbeat failed: {e}")
+
+
+STREAM_FORMATS = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+# Images still being finished after their stream was closed
+background_results = set()
+
+def format_stream_event(event: str, payload: dict, stream: str) -> str:
+    """Encode one streamed message as an NDJSON line or a Server-Sent Event."""
+    data = json.dumps(payload, default=str)
+    if stream == "sse":
+        return f"event: {event}\ndata: {data}\n\n"
+    return json.dumps({"event": event, **payload}, default=str) + "\n"
+
+async def stream_results(images: list, stream: str):
+    """
+    Process the claimed images and yield each result as soon as it completes,
+    followed by a summary. If the client goes away the remaining images are
+    still finished (and their leases renewed) in the background.
+    """
+    stop_heartbeat = asyncio.Event()
+    heartbeat = asyncio.create_task(heartbeat_leases([record["id"] for record in images], stop_heartbeat))
+    tasks = [asyncio.create_task(process_record(record)) for record in images]
+    counts = {"success": 0, "error": 0}
+    try:
+        yield format_stream_event("start", {"claimed": len(images)}, stream)
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            counts[result["status"]] += 1
+            yield format_stream_event("result", result, stream)
+        yield format_stream_event("done", {"message": "Bulk processing completed.",
+                                           "processed": len(images), **counts, **memory_budget.report()},
+                                  stream)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        if pending:
+            logger.warning(f"Stream closed with {len(pending)} images in progress; finishing them in the background.")
+            finished = asyncio.gather(*pending, return_exceptions=True)
+            background_results.add(finished)
+            finished.add_done_callback(background_results.discard)
+            finished.add_done_callback(lambda _: stop_heartbeat.set())
+        else:
+            stop_heartbeat.set()
+            await heartbeat
 
 @app.post("/bulk_auto_review")
-async def bulk_auto_review():
+async def bulk_auto_review(stream: str = None):
+    """
+    Process all images with review_status = 'downloaded' in a single request.
+    With ?stream=ndjson or ?stream=sse each result is streamed as soon as it is
+    ready instead of returning them all at the end.
+    """
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail=f"stream must be one of {', '.join(STREAM_FORMATS)}")
+
+    def reply(message: str):
+        if stream is None:
+            return {"message": message}
+        return StreamingResponse(iter([format_stream_event("done", {"message": message}, stream)]),
+                                 media_type=STREAM_FORMATS[stream])
+
     # Validate the API key before starting bulk processing
     try:
-        validate_gemini_api_key(genai_model)
+        await asyncio.get_running_loop().run_in_executor(executor, validate_gemini_api_key, genai_model)
     except HTTPException as e:
-        return {"message": e.detail}
+        return reply(e.detail)
+
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(executor, reap_expired_leases, "downloaded")
+    except Exception as e:
+        logger.error(f"Reaping expired leases failed: {e}")
 
-    """Process all images with review_status = 'downloaded' in a single request."""
-    images = get_images_with_status("downloaded")
+    images = await loop.run_in_executor(executor, get_images_with_status, "downloaded")
     if not images:
-        return {"message": "No images found with review_status='downloaded'."}
+        return reply("No images found with review_status='downloaded'.")
 
-    print(images)
+    logger.info(f"Claimed {len(images)} images for bulk auto review.")
+    # in_flight admits waiting tasks in creation order, so create them in scheduling order
+    images = fair_order(images)
+    memory_budget.reset_peak()
 
-    # Process all images concurrently
-    tasks = [process_record(record) for record in images]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    if stream is not None:
+        return StreamingResponse(stream_results(images, stream), media_type=STREAM_FORMATS[stream])
+
+    # Keep our leases alive while the batch is processed
+    stop_heartbeat = asyncio.Event()
+    heartbeat = asyncio.create_task(heartbeat_leases([record["id"] for record in images], stop_heartbeat))
+
+    # Process all images concurrently, at most MAX_IN_FLIGHT at a time
+    try:
+        tasks = [process_record(record) for record in images]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        stop_heartbeat.set()
+        await heartbeat
 
-    return {"message": "Bulk processing completed.", "results": results}
+    return {"message": "Bulk processing completed.", "results": results, **memory_budget.report()}
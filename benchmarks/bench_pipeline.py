@@ -0,0 +1,290 @@
+"""
+End-to-end pipeline benchmark against local fakes for S3, Gemini and Supabase.
+
+    python benchmarks/bench_pipeline.py --mode worker --images 200
+    python benchmarks/bench_pipeline.py --mode bulk --check          # compare with the saved baseline
+    python benchmarks/bench_pipeline.py --mode worker --save-baseline
+    python benchmarks/bench_pipeline.py --record responses.jsonl     # then --replay responses.jsonl
+
+No network access or quota is used: images come from a local HTTP server,
+the Gemini model is replaced by a fake behind the real GeminiClient, and the
+midbot_images table is an in-memory stand-in. Environment variables (e.g.
+MAX_IN_FLIGHT, ANALYSIS_BATCH_SIZE, PREPARE_PROCESSES) configure the pipeline
+as usual, so settings can be compared run against run. With --replay the
+model answers instantly from a recording, which isolates (and makes
+deterministic) everything but the model itself.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, "benchmarks", "baselines")
+sys.path.insert(0, ROOT)
+
+# Placeholders so the app imports without credentials; nothing reaches these services
+os.environ.setdefault("GEMINI_API_KEY", "offline-benchmark")
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+# The Supabase client only checks that the key looks like a JWT
+os.environ.setdefault("SUPABASE_ANON_KEY", "eyJhbGciOiJIUzI1NiJ9.e30.offline-benchmark")
+os.environ.setdefault("LIMIT", "50")
+os.environ.setdefault("RESULT_CACHE_ENABLED", "false")
+os.environ.setdefault("GEMINI_BACKOFF_BASE", "0.05")
+os.environ.setdefault("GEMINI_BACKOFF_MAX", "1")
+os.environ.setdefault("WORKER_IDLE_MIN", "0.05")
+os.environ.setdefault("WORKER_IDLE_MAX", "0.2")
+os.environ.setdefault("RESULT_CACHE_PATH", os.path.join(tempfile.mkdtemp(), "result_cache.sqlite3"))
+os.environ.setdefault("IMAGE_CACHE_DIR", os.path.join(tempfile.mkdtemp(), "image_cache"))
+
+from fakes import FakeGenerativeModel, FakeImageTable, FakeS3Server, load_corpus, make_corpus  # noqa: E402
+
+# Throughput may drop, and stage p95 grow, by this much before --check fails
+THROUGHPUT_TOLERANCE = 0.10
+LATENCY_TOLERANCE = 0.25
+# Ignore p95 changes smaller than this (seconds); tiny stages are noisy
+LATENCY_FLOOR = 0.002
+COLD_START_FLOOR = 0.1
+
+
+def percentiles(samples: list) -> dict:
+    values = np.asarray(samples)
+    return {"count": len(samples), "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)), "p99": float(np.percentile(values, 99))}
+
+
+def cold_start(mode: str) -> float:
+    """Seconds for a fresh interpreter to import the entry point, as when a worker is scaled up."""
+    module = "worker" if mode == "worker" else "app"
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def install_fakes(args):
+    """Import the app and swap its external services for the local fakes."""
+    import app
+    import supabase_utils
+    import worker
+    from gemini_utils import GeminiClient
+    from metrics_utils import add_stage_listener
+    from replay_utils import with_replay
+
+    corpus = make_corpus(args.corpus_size, (args.width, args.height))
+    named = load_corpus(args.corpus) if args.corpus else None
+    s3 = FakeS3Server(corpus, named, latency=args.s3_latency).start()
+    app.BASE_URL = s3.url
+
+    model = FakeGenerativeModel(latency=args.model_latency, error_rate=args.error_rate,
+                                rate_limit_rate=args.rate_limit_rate, seed=args.seed)
+    client = GeminiClient(model)
+    if args.record or args.replay:
+        client = with_replay(client, "record" if args.record else "replay", args.record or args.replay)
+    app.genai_model = client
+    app.analysis_batcher.genai_model = client
+    if app.cascade:
+        app.cascade.screen_model = GeminiClient(FakeGenerativeModel(latency=args.model_latency / 2, seed=args.seed,
+                                                                    model_name="models/fake-screen"))
+        app.cascade.strong_model = client
+
+    table = FakeImageTable.generate(args.images, latency=args.db_latency, big_job=args.big_job)
+    table.install(supabase_utils, app, worker)
+
+    # Keep the per-image log lines out of the report (logging_config set INFO on import)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    samples = {}
+    add_stage_listener(lambda stage, seconds: samples.setdefault(stage, []).append(seconds))
+    return app, worker, s3, model, client, table, samples
+
+
+async def run_worker(app, worker, table):
+    review_worker = worker.ReviewWorker()
+
+    async def stop_when_drained():
+        while table.count("downloaded") or review_worker.in_flight_ids:
+            await asyncio.sleep(0.05)
+        review_worker.stop()
+
+    stopper = asyncio.create_task(stop_when_drained())
+    await review_worker.run()
+    await stopper
+
+
+async def run_bulk(app, table):
+    while True:
+        response = await app.bulk_auto_review()
+        if "results" not in response:
+            break
+    app.get_result_writer().close()
+
+
+def measure(args) -> dict:
+    startup = cold_start(args.mode)
+    app, worker, s3, model, client, table, samples = install_fakes(args)
+    from memory_utils import peak_rss_bytes
+    from metrics_utils import add_stage_listener
+    from pool_utils import get_prepare_pool
+
+    cpu_start = time.process_time()
+    # cold_start's import subprocess has already been counted in RUSAGE_CHILDREN
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    first_result = []
+    add_stage_listener(lambda stage, seconds: stage == "total" and not first_result
+                       and first_result.append(time.perf_counter() - start))
+    asyncio.run(run_worker(app, worker, table) if args.mode == "worker" else run_bulk(app, table))
+    elapsed = time.perf_counter() - start
+
+    prepare_pool = get_prepare_pool()
+    if prepare_pool:
+        prepare_pool.close()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (time.process_time() - cpu_start + children.ru_utime - children_start.ru_utime
+           + children.ru_stime - children_start.ru_stime)
+    s3.stop()
+
+    done = len(table.rows) - table.count("downloaded") - table.count("processing")
+    # A job is done when its last result is written; this is the latency users see
+    job_finish = {}
+    for image_id, finished in table.finished.items():
+        job_id = table.rows[image_id]["job_id"]
+        job_finish[job_id] = max(job_finish.get(job_id, 0.0), finished - start)
+    errors = table.count("auto_review_error")
+    return {
+        "mode": args.mode,
+        "config": {
+            "images": args.images, "big_job": args.big_job, "corpus_size": args.corpus_size,
+            "image_size": [args.width, args.height],
+            "s3_latency": args.s3_latency, "model_latency": args.model_latency, "db_latency": args.db_latency,
+            "error_rate": args.error_rate, "rate_limit_rate": args.rate_limit_rate,
+            "env": {name: os.environ[name] for name in sorted(os.environ)
+                    if name.split("_")[0] in ("MAX", "ANALYSIS", "PREPARE", "WORKER", "MEMORY", "GEMINI",
+                                              "PREPROCESS", "PRESCREEN", "CASCADE", "NEAR", "RESULT", "LIMIT", "IMAGE")
+                    and "KEY" not in name and not name.endswith(("_PATH", "_DIR"))},
+        },
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "cores": os.cpu_count()},
+        "cold_start_s": startup,
+        "first_result_s": first_result[0] if first_result else None,
+        "images_done": done,
+        "errors": errors,
+        "elapsed_s": elapsed,
+        "images_per_sec": done / elapsed if elapsed else 0.0,
+        "cpu_s_per_image": cpu / done if done else 0.0,
+        "peak_rss_mb": peak_rss_bytes() / 1e6,
+        "model_calls": model.calls,
+        "gemini": dict(client.stats),
+        "db_writes": table.writes,
+        "stages": {stage: percentiles(values) for stage, values in sorted(samples.items())},
+        "job_finish_s": percentiles(list(job_finish.values())) if job_finish else None,
+    }
+
+
+def compare(result: dict, baseline: dict) -> list:
+    """Return human readable regressions of `result` against `baseline`."""
+    regressions = []
+    old, new = baseline["images_per_sec"], result["images_per_sec"]
+    if new < old * (1 - THROUGHPUT_TOLERANCE):
+        regressions.append(f"throughput {old:.1f} -> {new:.1f} images/s ({new / old - 1:+.0%})")
+    old, new = baseline.get("cold_start_s"), result["cold_start_s"]
+    if old and new > old * (1 + LATENCY_TOLERANCE) and new - old > COLD_START_FLOOR:
+        regressions.append(f"cold start {old:.2f} -> {new:.2f}s")
+    for stage, stats in result["stages"].items():
+        before = baseline["stages"].get(stage)
+        if not before:
+            continue
+        if stats["p95"] > before["p95"] * (1 + LATENCY_TOLERANCE) and stats["p95"] - before["p95"] > LATENCY_FLOOR:
+            regressions.append(f"{stage} p95 {before['p95'] * 1000:.1f} -> {stats['p95'] * 1000:.1f} ms")
+    return regressions
+
+
+def print_report(result: dict, baseline: dict = None):
+    print(f"\n{result['mode']}: {result['images_done']} images in {result['elapsed_s']:.2f}s "
+          f"= {result['images_per_sec']:.1f} images/s, {result['errors']} errors")
+    if "cold_start_s" in result:
+        print(f"Cold start: import {result['cold_start_s']:.2f}s, first result after "
+              f"{result['first_result_s'] or 0:.2f}s")
+    print(f"CPU {result['cpu_s_per_image'] * 1000:.1f} ms/image, process peak RSS {result['peak_rss_mb']:.0f} MB, "
+          f"{result['model_calls']} model calls, {result['db_writes']} DB writes")
+    jobs = result.get("job_finish_s")
+    if jobs:
+        print(f"Jobs finished after p50 {jobs['p50']:.2f}s, p95 {jobs['p95']:.2f}s, p99 {jobs['p99']:.2f}s "
+              f"({jobs['count']} jobs)")
+    header = f"{'stage':<10} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    print(header + ("  p95 vs baseline" if baseline else ""))
+    for stage, stats in result["stages"].items():
+        line = (f"{stage:<10} {stats['count']:>6} {stats['p50'] * 1000:>9.1f} "
+                f"{stats['p95'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}")
+        before = (baseline or {}).get("stages", {}).get(stage)
+        if before and before["p95"]:
+            line += f"  {stats['p95'] / before['p95'] - 1:+.0%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end pipeline benchmark.")
+    parser.add_argument("--mode", choices=("worker", "bulk"), default="worker",
+                        help="streaming worker or repeated /bulk_auto_review calls")
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--big-job", type=int, default=0,
+                        help="also queue one job with this many images ahead of the others (fairness check)")
+    parser.add_argument("--corpus", help="directory of real {job_id}__{index}.jpg files to serve")
+    parser.add_argument("--corpus-size", type=int, default=16, help="distinct generated images")
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--s3-latency", type=float, default=0.02)
+    parser.add_argument("--model-latency", type=float, default=0.2)
+    parser.add_argument("--db-latency", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of model calls failing with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of model calls failing with 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--record", help="record the fake model's responses to this file")
+    parser.add_argument("--replay", help="serve model responses from this recording instead of the fake model")
+    parser.add_argument("--json", help="also write the result to this file")
+    parser.add_argument("--baseline", help="baseline file (default: benchmarks/baselines/<mode>.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--check", action="store_true", help="exit non-zero on a regression against the baseline")
+    args = parser.parse_args()
+
+    baseline_path = args.baseline or os.path.join(BASELINE_DIR, f"{args.mode}.json")
+    baseline = None
+    if os.path.exists(baseline_path) and not args.save_baseline:
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+
+    result = measure(args)
+    print_report(result, baseline)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, "w") as file:
+            json.dump(result, file, indent=2)
+            file.write("\n")
+        print(f"Baseline saved to {baseline_path}")
+
+    if baseline:
+        if baseline["config"] != result["config"]:
+            print("Note: baseline was recorded with a different configuration.")
+        regressions = compare(result, baseline)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions and args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
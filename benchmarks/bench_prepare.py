@@ -0,0 +1,79 @@
+"""
+Throughput of image preparation in threads (the default) versus the process pool.
+
+    python benchmarks/bench_prepare.py --images 200 --threads 8 --processes auto
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analysis_utils import prepare_image, PREPROCESS_POLICIES  # noqa: E402
+from pool_utils import PreparePool, available_cores  # noqa: E402
+
+
+def make_images(count: int, size: tuple, distinct: int = 8) -> list:
+    """Photo-like JPEGs (smooth gradients plus noise) so decode and re-encode do real work."""
+    width, height = size
+    rng = np.random.default_rng(0)
+    samples = []
+    for _ in range(distinct):
+        x = np.linspace(0, 255, width)[None, :, None]
+        y = np.linspace(0, 255, height)[:, None, None]
+        base = (x * rng.random(3) + y * rng.random(3)) / 2
+        pixels = np.clip(base + rng.normal(0, 12, (height, width, 3)), 0, 255).astype(np.uint8)
+        with io.BytesIO() as output:
+            Image.fromarray(pixels).save(output, format="JPEG", quality=92)
+            samples.append(output.getvalue())
+    return [samples[i % distinct] for i in range(count)]
+
+
+def run(prepare, images: list, threads: int, policy) -> float:
+    """Prepare all images with `threads` callers and return images per second."""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda data: prepare(data, policy), images))
+    return len(images) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--width", type=int, default=3000)
+    parser.add_argument("--height", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8, help="concurrent callers, like the prepare stage")
+    parser.add_argument("--processes", default="auto", help='worker processes, or "auto" for available cores')
+    parser.add_argument("--policy", default="v1", choices=sorted(PREPROCESS_POLICIES))
+    args = parser.parse_args()
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    policy = PREPROCESS_POLICIES[args.policy]
+    images = make_images(args.images, (args.width, args.height))
+    processes = available_cores() if args.processes == "auto" else int(args.processes)
+    print(f"{args.images} JPEGs of {args.width}x{args.height} "
+          f"({sum(map(len, images)) / len(images) / 1e6:.2f} MB avg), policy {args.policy}, "
+          f"{args.threads} callers, {available_cores()} cores available")
+
+    in_thread = run(prepare_image, images, args.threads, policy)
+    print(f"in-thread:           {in_thread:8.1f} images/s")
+
+    pool = PreparePool(processes)
+    try:
+        run(pool.prepare, images[:processes * 2], args.threads, policy)  # start the worker processes
+        in_process = run(pool.prepare, images, args.threads, policy)
+    finally:
+        pool.close()
+    print(f"process pool ({processes:>2}):   {in_process:8.1f} images/s  ({in_process / in_thread:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Local stand-ins for S3, Gemini and the midbot_images table, for offline benchmarks.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from google.api_core import exceptions as google_exceptions
+from PIL import Image
+
+
+def make_corpus(count: int, size: tuple = (1600, 1200), seed: int = 0) -> list:
+    """Photo-like JPEGs (gradients plus noise) so decoding and re-encoding do real work."""
+    width, height = size
+    rng = np.random.default_rng(seed)
+    corpus = []
+    for _ in range(count):
+        x = np.linspace(0, 255, width)[None, :, None]
+        y = np.linspace(0, 255, height)[:, None, None]
+        base = (x * rng.random(3) + y * rng.random(3)) / 2
+        pixels = np.clip(base + rng.normal(0, 12, (height, width, 3)), 0, 255).astype(np.uint8)
+        with io.BytesIO() as output:
+            Image.fromarray(pixels).save(output, format="JPEG", quality=90)
+            corpus.append(output.getvalue())
+    return corpus
+
+
+def load_corpus(directory: str) -> dict:
+    """Read real `{job_id}__{index}.jpg` files, keyed by file name."""
+    corpus = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".jpg"):
+            with open(os.path.join(directory, name), "rb") as file:
+                corpus[name] = file.read()
+    return corpus
+
+
+class FakeS3Server:
+    """
+    Serves `/{job_id}__{index}.jpg` over HTTP with a configurable latency and
+    S3-style ETags (answering If-None-Match with 304 Not Modified).
+    Files from a real corpus are served by name; any other name maps onto the
+    generated corpus by index.
+    """
+
+    def __init__(self, generated: list, named: dict = None, latency: float = 0.0):
+        self.generated = generated
+        self.named = named or {}
+        self.latency = latency
+        self.requests = 0
+        self.not_modified = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests += 1
+                name = self.path.lstrip("/")
+                data = server.named.get(name)
+                if data is None and server.generated:
+                    try:
+                        index = int(name.rsplit("__", 1)[1].split(".")[0])
+                        data = server.generated[index % len(server.generated)]
+                    except (IndexError, ValueError):
+                        data = None
+                if server.latency:
+                    time.sleep(server.latency)
+                if data is None:
+                    self.send_error(404)
+                    return
+                etag = f'"{hashlib.md5(data).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-s3", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.usage_metadata = None
+
+
+class FakeGenerativeModel:
+    """
+    Drop-in for genai.GenerativeModel: answers after `latency` seconds (with
+    +-50% jitter), failing with a 429 or a 503 at the given rates.
+    Verdicts are random but deterministic for a seed.
+    """
+
+    def __init__(self, latency: float = 0.5, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 seed: int = 0, model_name: str = "models/fake-gemini"):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.model_name = model_name
+        self.calls = 0
+        self._random = random.Random(seed)
+
+    def _answer(self, contents: list) -> FakeResponse:
+        self.calls += 1
+        roll = self._random.random()
+        if roll < self.rate_limit_rate:
+            raise google_exceptions.ResourceExhausted("429 Quota exceeded (fake)")
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise google_exceptions.ServiceUnavailable("503 Service unavailable (fake)")
+
+        images = sum(1 for part in contents if not isinstance(part, str))
+        answers = [self._analysis(number + 1) for number in range(images)]
+        if images > 1:
+            return FakeResponse(json.dumps(answers))
+        return FakeResponse(json.dumps(answers[0] if answers else {"ok": True}))
+
+    def _analysis(self, number: int) -> dict:
+        flag = lambda rate: self._random.random() < rate
+        text_present = flag(0.3)
+        return {
+            "image": number,
+            "text_present": text_present,
+            "text_analysis": {"has_spelling_errors": text_present and flag(0.2),
+                              "correct_spelling": text_present and flag(0.8)},
+            "watermark_present": flag(0.05),
+            "contains_humans": flag(0.4),
+            "contains_nudity": flag(0.01),
+            "contains_blood_violence": flag(0.01),
+            "contains_brands": flag(0.05),
+            "copyright_content": flag(0.02),
+            "recognizable_places": flag(0.05),
+            "recognizable_people": flag(0.02),
+            "details": "Fake analysis for benchmarking.",
+            "confidence": 0.9,
+        }
+
+    def _delay(self) -> float:
+        return self.latency * self._random.uniform(0.5, 1.5)
+
+    async def generate_content_async(self, contents: list, **kwargs):
+        await asyncio.sleep(self._delay())
+        return self._answer(contents)
+
+    def generate_content(self, contents: list, **kwargs):
+        time.sleep(self._delay())
+        return self._answer(contents)
+
+
+class FakeImageTable:
+    """
+    In-memory midbot_images table implementing the supabase_utils functions the
+    pipeline calls: claiming, lease renewal and reaping, and result writes.
+    Records when each row's result was written, to measure per-job latency.
+    """
+
+    def __init__(self, rows: list, latency: float = 0.0):
+        self.rows = {row["id"]: dict(row) for row in rows}
+        self.latency = latency
+        self.writes = 0
+        self.finished = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def generate(cls, count: int, images_per_job: int = 4, latency: float = 0.0, big_job: int = 0):
+        """`count` rows in jobs of images_per_job, optionally preceded by one job of big_job rows."""
+        rows = [{"id": f"img-big-{i}", "job_id": "job-big", "image_index": i, "review_priority": 0,
+                 "review_status": "downloaded"} for i in range(big_job)]
+        rows += [{"id": f"img-{i}", "job_id": f"job-{i // images_per_job}", "image_index": i, "review_priority": 0,
+                  "review_status": "downloaded"} for i in range(count)]
+        return cls(rows, latency)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def claim_images(self, status: str, limit: int = None, owner: str = "bench", lease_seconds: int = 300):
+        self._wait()
+        with self._lock:
+            # Same order as claim_midbot_images: priority, then round-robin across jobs, oldest first
+            job_ranks, ranked = {}, []
+            for created, row in enumerate(self.rows.values()):
+                if row["review_status"] == status:
+                    job_ranks[row["job_id"]] = rank = job_ranks.get(row["job_id"], 0) + 1
+                    ranked.append((-row.get("review_priority", 0), rank, created, row))
+            claimed = [entry[-1] for entry in sorted(ranked, key=lambda entry: entry[:3])][:limit or 50]
+            for row in claimed:
+                row["review_status"] = "processing"
+            return [dict(row) for row in claimed]
+
+    def get_images_with_status(self, status: str):
+        return self.claim_images(status)
+
+    def renew_leases(self, image_ids: list, owner: str = "bench", lease_seconds: int = 300) -> int:
+        return len(image_ids)
+
+    def reap_expired_leases(self, status: str = "downloaded") -> int:
+        return 0
+
+    def update_auto_review_results(self, image_id, auto_review_status, review_status, auto_review_details):
+        self.update_auto_review_results_bulk([{"id": image_id, "auto_review_status": auto_review_status,
+                                               "review_status": review_status,
+                                               "auto_review_details": auto_review_details}])
+
+    def update_auto_review_results_bulk(self, rows: list) -> int:
+        self._wait()
+        with self._lock:
+            for row in rows:
+                self.rows[row["id"]].update(row)
+                self.finished[row["id"]] = time.perf_counter()
+            self.writes += 1
+        return len(rows)
+
+    def count(self, review_status: str) -> int:
+        with self._lock:
+            return sum(1 for row in self.rows.values() if row["review_status"] == review_status)
+
+    def install(self, *modules):
+        """Replace the Supabase functions in the given modules with this table's methods."""
+        for module in modules:
+            for name in ("claim_images", "get_images_with_status", "renew_leases", "reap_expired_leases",
+                         "update_auto_review_results", "update_auto_review_results_bulk"):
+                if hasattr(module, name):
+                    setattr(module, name, getattr(self, name))
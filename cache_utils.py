@@ -0,0 +1,102 @@
+import hashlib
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+from analysis_utils import ANALYSIS_PROMPT
+from lru_utils import SQLiteLRU
+
+load_dotenv()
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "result_cache.sqlite3")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+PROMPT_HASH = hashlib.sha256(ANALYSIS_PROMPT.encode()).hexdigest()
+
+
+def result_cache_key(image_bytes: bytes, model_name: str, policy_version: str = "") -> str:
+    """
+    Build the cache key for an analysis result.
+    The preprocessing policy is part of the key because it changes what the model sees.
+    """
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    return f"{image_hash}:{PROMPT_HASH[:16]}:{model_name}:{policy_version}"
+
+
+class ResultCache(SQLiteLRU):
+    """
+    Persistent SQLite cache of (categories, details) per image/prompt/model.
+    Entries are evicted least-recently-used first once the stored size
+    exceeds max_bytes. Hit and miss counts are kept for the process lifetime.
+    """
+
+    name = "Result cache"
+    table = "results"
+    key_column = "key"
+
+    def __init__(self, path: str = RESULT_CACHE_PATH, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.hits = 0
+        self.misses = 0
+        super().__init__(path, max_bytes)
+
+    def _create_tables(self):
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " categories TEXT NOT NULL,"
+            " details TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def get(self, key: str):
+        """Return the cached (categories, details) for key, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT categories, details FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0], row[1]
+
+    def put(self, key: str, categories: str, details: str):
+        """Store a result, evicting the least recently used entries if over budget."""
+        size = len(key) + len(categories.encode()) + len(details.encode())
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, categories, details, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, categories, details, size, time.time())
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _drop(self, key: str, size: int):
+        self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": self._total_bytes}
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """Return the process-wide result cache, or None if caching is disabled."""
+    global _result_cache
+    if not RESULT_CACHE_ENABLED:
+        return None
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
@@ -0,0 +1,150 @@
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+from logging_config import logger
+
+load_dotenv()
+
+# off: disabled, reuse: inherit the verdict of a near-duplicate,
+# shadow: still call the model but log whether the inherited verdict would have matched
+NEAR_DUP_MODE = os.getenv("NEAR_DUP_MODE", "off").lower()
+NEAR_DUP_MAX_DISTANCE = int(os.getenv("NEAR_DUP_MAX_DISTANCE", "4"))
+# job: only match siblings of the same job_id, global: match across all jobs
+NEAR_DUP_SCOPE = os.getenv("NEAR_DUP_SCOPE", "job").lower()
+NEAR_DUP_MAX_SCOPES = int(os.getenv("NEAR_DUP_MAX_SCOPES", "1000"))
+
+# Marker prefixed to the details of inherited verdicts so they can be spot checked
+INHERITED_MARKER = "[inherited]"
+
+HASH_SIZE = 8
+
+
+def dhash(img: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """Return the 64-bit difference hash of an already decoded image."""
+    thumb = img.resize((hash_size + 1, hash_size), Image.BOX).convert("L")
+    pixels = np.asarray(thumb, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+@dataclass
+class ReviewedImage:
+    """A reviewed image whose verdict can be inherited."""
+    image_hash: int
+    image_id: str
+    category: str
+    details: str
+
+
+class BKTree:
+    """BK-tree over hamming distance for nearest-neighbour lookups of image hashes."""
+
+    def __init__(self):
+        self._root = None
+        self.size = 0
+
+    def add(self, item: ReviewedImage):
+        self.size += 1
+        if self._root is None:
+            self._root = (item, {})
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(item.image_hash, node[0].image_hash)
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (item, {})
+                return
+            node = child
+
+    def nearest(self, image_hash: int, max_distance: int):
+        """Return (item, distance) of the closest item within max_distance, or None."""
+        if self._root is None:
+            return None
+        best = None
+        stack = [self._root]
+        while stack:
+            item, children = stack.pop()
+            distance = hamming_distance(image_hash, item.image_hash)
+            if distance <= max_distance and (best is None or distance < best[1]):
+                best = (item, distance)
+                if distance == 0:
+                    break
+            low, high = distance - max_distance, distance + max_distance
+            stack.extend(child for d, child in children.items() if low <= d <= high)
+        return best
+
+
+class NearDuplicateIndex:
+    """
+    Index of reviewed image hashes, one BK-tree per scope (job_id or global).
+    The least recently used scopes are dropped beyond max_scopes.
+    """
+
+    def __init__(self, max_distance: int = NEAR_DUP_MAX_DISTANCE, scope: str = NEAR_DUP_SCOPE,
+                 max_scopes: int = NEAR_DUP_MAX_SCOPES):
+        self.max_distance = max_distance
+        self.scope = scope
+        self.max_scopes = max_scopes
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _scope_key(self, job_id: str) -> str:
+        return job_id if self.scope == "job" else ""
+
+    def find(self, image_hash: int, job_id: str):
+        """Return (ReviewedImage, distance) for the nearest reviewed image, or None."""
+        if image_hash is None:
+            return None
+        with self._lock:
+            tree = self._trees.get(self._scope_key(job_id))
+            if tree is None:
+                return None
+            return tree.nearest(image_hash, self.max_distance)
+
+    def add(self, image_hash: int, job_id: str, image_id: str, category: str, details: str):
+        if image_hash is None:
+            return
+        key = self._scope_key(job_id)
+        with self._lock:
+            tree = self._trees.get(key)
+            if tree is None:
+                tree = self._trees[key] = BKTree()
+                while len(self._trees) > self.max_scopes:
+                    self._trees.popitem(last=False)
+            else:
+                self._trees.move_to_end(key)
+            tree.add(ReviewedImage(image_hash, image_id, category, details))
+
+
+def inherited_details(duplicate: ReviewedImage, distance: int) -> str:
+    """Details string for a verdict inherited from a near-duplicate."""
+    return f"{INHERITED_MARKER} from {duplicate.image_id} (distance {distance}): {duplicate.details}"
+
+
+_index = None
+_index_lock = threading.Lock()
+
+def near_duplicates_enabled() -> bool:
+    """True when images need a dHash for the near-duplicate index."""
+    return NEAR_DUP_MODE != "off"
+
+def get_near_duplicate_index():
+    """Return the process-wide near-duplicate index, or None if disabled."""
+    global _index
+    if not near_duplicates_enabled():
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = NearDuplicateIndex()
+            logger.info(f"Near-duplicate detection enabled: mode={NEAR_DUP_MODE}, "
+                        f"max_distance={NEAR_DUP_MAX_DISTANCE}, scope={NEAR_DUP_SCOPE}")
+        return _index
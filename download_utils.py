@@ -0,0 +1,290 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from io import BytesIO
+
+import pycurl
+from dotenv import load_dotenv
+from PIL import Image
+from logging_config import logger
+
+load_dotenv()
+
+# Connection and size limits for image downloads
+DOWNLOAD_MAX_CONNECTIONS = int(os.getenv("DOWNLOAD_MAX_CONNECTIONS", "16"))
+DOWNLOAD_CONNECT_TIMEOUT = int(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", "10"))
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "60"))
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+# Largest image we decode, in pixels (0 = no limit); bigger JPEGs are decoded downscaled, others rejected
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(30_000_000)))
+
+# Bytes received before the image header is checked against IMAGE_MAX_PIXELS
+HEADER_SNIFF_BYTES = 64 * 1024
+# JPEGs can be decoded at 1/2, 1/4 or 1/8 scale per side (Image.draft)
+JPEG_MAX_DRAFT_SCALE = 8
+
+# Pixel limits are enforced by check_image_header and prepare_image, which also
+# allow large JPEGs that are decoded downscaled; Pillow's own check would refuse them
+Image.MAX_IMAGE_PIXELS = None
+
+DEFAULT_HEADERS = [
+    "accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
+    "accept-language: en-GB,en;q=0.9",
+    "priority: u=0, i",
+    "sec-ch-ua: \"Google Chrome\";v=\"131\", \"Chromium\";v=\"131\", \"Not_A Brand\";v=\"24\"",
+    "sec-ch-ua-mobile: ?0",
+    "sec-ch-ua-platform: \"Windows\"",
+    "sec-fetch-dest: document",
+    "sec-fetch-mode: navigate",
+    "sec-fetch-site: none",
+    "sec-fetch-user: ?1",
+    "upgrade-insecure-requests: 1",
+    "user-agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
+]
+
+
+class DownloadTooLarge(RuntimeError):
+    """Raised when a response body exceeds the configured max bytes."""
+
+
+class ImageTooLarge(RuntimeError):
+    """Raised when an image cannot be decoded within the configured max pixels."""
+
+
+def check_image_header(header: bytes, max_pixels: int = IMAGE_MAX_PIXELS):
+    """
+    Read format and dimensions from the start of an image with Pillow's lazy open.
+    Returns (format, size), or None if the header is incomplete or unknown.
+    Raises ImageTooLarge if even the smallest decode would exceed max_pixels.
+    """
+    try:
+        with Image.open(BytesIO(header)) as img:
+            format_, (width, height) = img.format, img.size
+    except Exception:
+        return None
+    scale = JPEG_MAX_DRAFT_SCALE if format_ == "JPEG" else 1
+    if max_pixels and -(-width // scale) * -(-height // scale) > max_pixels:
+        raise ImageTooLarge(f"{format_} image of {width}x{height} pixels exceeds the {max_pixels} pixel limit")
+    return format_, (width, height)
+
+
+@dataclass
+class Download:
+    """Result of a conditional download; body is empty when the object was not modified."""
+    body: bytes
+    etag: str = None
+    not_modified: bool = False
+
+
+class _Transfer:
+    """State of a single in-flight download."""
+
+    def __init__(self, url: str, future: Future, max_bytes: int, max_pixels: int = 0, etag: str = None,
+                 conditional: bool = False):
+        self.url = url
+        self.future = future
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.rejected = None
+        self.etag = etag
+        self.conditional = conditional
+        self.response_etag = None
+        self.buffer = BytesIO()
+        self.too_large = False
+
+    def header(self, line: bytes):
+        name, _, value = line.decode("iso-8859-1").partition(":")
+        if name.strip().lower() == "etag":
+            self.response_etag = value.strip()
+
+    def write(self, chunk: bytes):
+        if self.buffer.tell() + len(chunk) > self.max_bytes:
+            self.too_large = True
+            return 0  # Returning a short count makes libcurl abort the transfer
+        before = self.buffer.tell()
+        self.buffer.write(chunk)
+        if self.max_pixels and before < HEADER_SNIFF_BYTES <= self.buffer.tell():
+            # Stop oversized images once their header has arrived instead of downloading the rest
+            try:
+                check_image_header(self.buffer.getvalue(), self.max_pixels)
+            except ImageTooLarge as e:
+                self.rejected = e
+                return 0
+        return None
+
+
+class CurlDownloader:
+    """
+    Pooled downloader built on pycurl.CurlMulti.
+
+    Easy handles are reused, so connections (and TLS sessions) to the S3 host
+    stay alive between images, and many transfers run at once on one thread.
+    Use submit() to get a Future or fetch() to block for the bytes.
+    """
+
+    def __init__(self, max_connections: int = DOWNLOAD_MAX_CONNECTIONS,
+                 connect_timeout: int = DOWNLOAD_CONNECT_TIMEOUT,
+                 timeout: int = DOWNLOAD_TIMEOUT,
+                 max_bytes: int = DOWNLOAD_MAX_BYTES,
+                 max_pixels: int = IMAGE_MAX_PIXELS,
+                 headers: list = None):
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.headers = headers if headers is not None else DEFAULT_HEADERS
+
+        # Share DNS and TLS session caches between handles
+        self._share = pycurl.CurlShare()
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+        self._multi = pycurl.CurlMulti()
+        self._multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+        self._multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, max_connections)
+        self._multi.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, max_connections)
+
+        self._free_handles = [self._new_handle() for _ in range(max_connections)]
+        self._pending = deque()
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="curl-downloader", daemon=True)
+        self._thread.start()
+
+    def _new_handle(self) -> pycurl.Curl:
+        c = pycurl.Curl()
+        c.setopt(pycurl.SHARE, self._share)
+        c.setopt(pycurl.HTTPHEADER, self.headers)
+        c.setopt(pycurl.FOLLOWLOCATION, True)
+        c.setopt(pycurl.MAXREDIRS, 5)
+        c.setopt(pycurl.CONNECTTIMEOUT, self.connect_timeout)
+        c.setopt(pycurl.TIMEOUT, self.timeout)
+        c.setopt(pycurl.MAXFILESIZE, self.max_bytes)
+        c.setopt(pycurl.NOSIGNAL, 1)
+        c.setopt(pycurl.TCP_KEEPALIVE, 1)
+        c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+        c.setopt(pycurl.PIPEWAIT, 1)
+        return c
+
+    def submit(self, url: str) -> Future:
+        """Queue a download and return a Future resolving to the body bytes."""
+        return self._submit(url)
+
+    def submit_conditional(self, url: str, etag: str = None) -> Future:
+        """
+        Queue a download sent with If-None-Match when `etag` is given.
+        The Future resolves to a Download, with not_modified set on a 304.
+        """
+        return self._submit(url, etag, conditional=True)
+
+    def _submit(self, url: str, etag: str = None, conditional: bool = False) -> Future:
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Downloader is closed")
+            self._pending.append(_Transfer(url, future, self.max_bytes, self.max_pixels, etag, conditional))
+        self._wakeup.set()
+        return future
+
+    def fetch(self, url: str) -> bytes:
+        """Download the URL and return its body, blocking until done."""
+        return self.submit(url).result()
+
+    def close(self):
+        """Stop the transfer thread and release all handles."""
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def _start_pending(self):
+        with self._lock:
+            while self._pending and self._free_handles:
+                transfer = self._pending.popleft()
+                if not transfer.future.set_running_or_notify_cancel():
+                    continue
+                c = self._free_handles.pop()
+                c.setopt(pycurl.URL, transfer.url)
+                c.setopt(pycurl.WRITEFUNCTION, transfer.write)
+                c.setopt(pycurl.HEADERFUNCTION, transfer.header)
+                # Handles are reused, so the validator header is set (or cleared) on every transfer
+                c.setopt(pycurl.HTTPHEADER, self.headers + ([f"if-none-match: {transfer.etag}"]
+                                                            if transfer.etag else []))
+                self._active[c] = transfer
+                self._multi.add_handle(c)
+
+    def _finish(self, c: pycurl.Curl, errno: int = 0, errmsg: str = ""):
+        transfer = self._active.pop(c)
+        self._multi.remove_handle(c)
+        status = c.getinfo(pycurl.RESPONSE_CODE)
+        c.setopt(pycurl.WRITEFUNCTION, lambda chunk: None)
+        c.setopt(pycurl.HEADERFUNCTION, lambda line: None)
+        with self._lock:
+            self._free_handles.append(c)
+
+        if transfer.rejected:
+            transfer.future.set_exception(ImageTooLarge(f"Failed to download image: {transfer.rejected}"))
+        elif transfer.too_large or errno == pycurl.E_FILESIZE_EXCEEDED:
+            transfer.future.set_exception(
+                DownloadTooLarge(f"Failed to download image: {transfer.url} exceeds {transfer.max_bytes} bytes"))
+        elif errno:
+            transfer.future.set_exception(RuntimeError(f"Failed to download image: ({errno}) {errmsg}"))
+        elif status >= 400:
+            transfer.future.set_exception(RuntimeError(f"Failed to download image: HTTP {status} for {transfer.url}"))
+        elif transfer.conditional:
+            transfer.future.set_result(Download(transfer.buffer.getvalue(), transfer.response_etag or transfer.etag,
+                                                not_modified=status == 304))
+        else:
+            transfer.future.set_result(transfer.buffer.getvalue())
+
+    def _run(self):
+        while True:
+            self._start_pending()
+            with self._lock:
+                closed = self._closed
+            if not self._active:
+                if closed:
+                    break
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            while True:
+                ret, _ = self._multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            while True:
+                queued, ok_list, err_list = self._multi.info_read()
+                for c in ok_list:
+                    self._finish(c)
+                for c, errno, errmsg in err_list:
+                    self._finish(c, errno, errmsg)
+                if queued == 0:
+                    break
+
+            if self._active:
+                # Short timeout so newly submitted URLs are picked up promptly
+                self._multi.select(0.05)
+
+        for c in self._free_handles:
+            c.close()
+        self._multi.close()
+        logger.info("Downloader stopped.")
+
+
+_downloader = None
+_downloader_lock = threading.Lock()
+
+def get_downloader() -> CurlDownloader:
+    """Return the process-wide downloader, creating it on first use."""
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None:
+            _downloader = CurlDownloader()
+        return _downloader
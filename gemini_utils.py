@@ -0,0 +1,282 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+from dotenv import load_dotenv
+from google.api_core import exceptions as google_exceptions
+from logging_config import logger
+from metrics_utils import stage_timer
+
+load_dotenv()
+
+# Quota limits (0 disables the limiter)
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "0"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "0"))
+# Adaptive concurrency bounds for model calls
+GEMINI_INITIAL_CONCURRENCY = int(os.getenv("GEMINI_INITIAL_CONCURRENCY", "4"))
+GEMINI_MIN_CONCURRENCY = int(os.getenv("GEMINI_MIN_CONCURRENCY", "1"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "64"))
+# Retries of rate-limited and transient failures
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "60"))
+
+# Gemini bills each inline image as a fixed number of tokens
+IMAGE_TOKENS = 258
+# Rough allowance for the JSON answer when estimating a request's tokens
+RESPONSE_TOKENS = 300
+
+RATE_LIMIT = "rate_limit"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+
+class LazyGenerativeModel:
+    """
+    A genai.GenerativeModel that is created on first use. Importing and
+    configuring google.generativeai takes about a second, which processes that
+    never call the model (or call it much later) should not pay at startup.
+    """
+
+    def __init__(self, api_key: str, model_name: str):
+        self.api_key = api_key
+        # Same name the SDK model reports, so result cache keys do not change
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._model is None:
+                import google.generativeai as genai
+
+                start = time.perf_counter()
+                genai.configure(api_key=self.api_key)
+                self._model = genai.GenerativeModel(self.model_name)
+                logger.info(f"Loaded Gemini model {self.model_name} in {time.perf_counter() - start:.2f}s.")
+        return self._model
+
+    def generate_content(self, contents: list, **kwargs):
+        return (self._model or self._load()).generate_content(contents=contents, **kwargs)
+
+    async def generate_content_async(self, contents: list, **kwargs):
+        model = self._model
+        if model is None:
+            # Keep the one-off import off the event loop
+            model = await asyncio.get_running_loop().run_in_executor(None, self._load)
+        return await model.generate_content_async(contents=contents, **kwargs)
+
+
+def configure_gemini(api_key: str, model_name: str = 'gemini-1.5-flash'):
+    """Configure the generative AI model. The SDK is loaded on the first call."""
+    return LazyGenerativeModel(api_key, model_name)
+
+
+def classify_error(error: Exception) -> str:
+    """Classify a model call failure as rate_limit, transient or fatal."""
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        return RATE_LIMIT
+    if isinstance(error, (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                          google_exceptions.DeadlineExceeded, google_exceptions.GatewayTimeout,
+                          google_exceptions.Aborted, asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return TRANSIENT
+    message = str(error).lower()
+    if "429" in message or "quota" in message or "rate limit" in message:
+        return RATE_LIMIT
+    if "503" in message or "500" in message or "timeout" in message or "unavailable" in message:
+        return TRANSIENT
+    return FATAL
+
+
+def estimate_tokens(contents: list) -> int:
+    """Estimate the tokens a request will consume, before the real count is known."""
+    tokens = RESPONSE_TOKENS
+    for part in contents:
+        if isinstance(part, str):
+            tokens += len(part) // 4
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def backoff_delay(attempt: int, base: float = GEMINI_BACKOFF_BASE, cap: float = GEMINI_BACKOFF_MAX) -> float:
+    """Full-jitter exponential backoff for the given (1-based) retry attempt."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class GeminiRequestError(RuntimeError):
+    """A model call failed for good; `kind` is the classify_error result."""
+
+    def __init__(self, message: str, kind: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `per_minute`.
+    reserve() takes tokens immediately (going negative if needed) and returns
+    how long the caller must wait, so sync and async callers can share it.
+    """
+
+    def __init__(self, per_minute: int, capacity: int = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float = 1) -> float:
+        """Take `amount` tokens and return the seconds to wait before using them."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def adjust(self, amount: float):
+        """Take (or give back, if negative) tokens after the real usage is known."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on concurrent model calls: the limit grows by about one per
+    round of successful calls and halves on a rate-limit response (at most
+    once per `cooldown` seconds, so one burst of 429s counts once).
+    """
+
+    def __init__(self, initial: int = GEMINI_INITIAL_CONCURRENCY, minimum: int = GEMINI_MIN_CONCURRENCY,
+                 maximum: int = GEMINI_MAX_CONCURRENCY, cooldown: float = 5.0):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, kind: str = None):
+        async with self._condition:
+            self.in_flight -= 1
+            self.record(kind)
+            self._condition.notify_all()
+
+    def record(self, kind: str = None):
+        """Feed back the outcome of a call: None for success, or a classify_error kind."""
+        if kind is None:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        elif kind == RATE_LIMIT:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self._last_decrease = now
+                self.limit = max(self.minimum, self.limit / 2)
+                logger.warning(f"Gemini rate limited; concurrency limit lowered to {int(self.limit)}.")
+
+
+class GeminiClient:
+    """
+    Shared, rate-aware wrapper around a GenerativeModel.
+
+    Exposes generate_content / generate_content_async like the SDK model, so it
+    can be passed anywhere a genai_model is expected. Calls are admitted by the
+    request and token buckets and the adaptive concurrency limit. Rate-limited
+    and transient failures are retried with jittered exponential backoff; other
+    failures raise GeminiRequestError straight away.
+    """
+
+    def __init__(self, model, rpm: int = GEMINI_RPM, tpm: int = GEMINI_TPM, max_retries: int = GEMINI_MAX_RETRIES,
+                 concurrency: AdaptiveConcurrency = None):
+        self.model = model
+        self.model_name = getattr(model, "model_name", str(model))
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self.stats = {"calls": 0, "retries": 0, RATE_LIMIT: 0, TRANSIENT: 0, FATAL: 0}
+
+    def _reserve(self, contents: list) -> (float, int):
+        estimate = estimate_tokens(contents)
+        wait = max(self.requests.reserve(1), self.tokens.reserve(estimate))
+        return wait, estimate
+
+    def _settle(self, response, estimate: int):
+        usage = getattr(response, "usage_metadata", None)
+        actual = getattr(usage, "total_token_count", None) if usage is not None else None
+        if actual:
+            self.tokens.adjust(actual - estimate)
+
+    def _failed(self, error: Exception, attempt: int, max_retries: int) -> (str, bool):
+        """Record a failure and return (kind, retry)."""
+        kind = classify_error(error)
+        self.stats[kind] += 1
+        retry = kind != FATAL and attempt <= max_retries
+        logger.error(f"Gemini call failed ({kind}, attempt {attempt}): {error}")
+        if retry:
+            self.stats["retries"] += 1
+        return kind, retry
+
+    async def generate_content_async(self, contents: list, max_retries: int = None, **kwargs):
+        """Call the model; `max_retries` overrides the client's retry limit for this call."""
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            attempt += 1
+            wait, estimate = self._reserve(contents)
+            if wait:
+                await asyncio.sleep(wait)
+            await self.concurrency.acquire()
+            kind = None
+            try:
+                self.stats["calls"] += 1
+                with stage_timer("gemini"):
+                    response = await self.model.generate_content_async(contents=contents, **kwargs)
+                self._settle(response, estimate)
+                return response
+            except Exception as e:
+                kind, retry = self._failed(e, attempt, max_retries)
+                if not retry:
+                    raise GeminiRequestError(f"Gemini call failed after {attempt} attempts: {e}", kind) from e
+            finally:
+                await self.concurrency.release(kind)
+            await asyncio.sleep(backoff_delay(attempt))
+
+    def generate_content(self, contents: list, max_retries: int = None, **kwargs):
+        """Blocking variant; shares the rate buckets and feeds the concurrency limit."""
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            attempt += 1
+            wait, estimate = self._reserve(contents)
+            if wait:
+                time.sleep(wait)
+            try:
+                self.stats["calls"] += 1
+                with stage_timer("gemini"):
+                    response = self.model.generate_content(contents=contents, **kwargs)
+                self._settle(response, estimate)
+                self.concurrency.record(None)
+                return response
+            except Exception as e:
+                kind, retry = self._failed(e, attempt, max_retries)
+                self.concurrency.record(kind)
+                if not retry:
+                    raise GeminiRequestError(f"Gemini call failed after {attempt} attempts: {e}", kind) from e
+            time.sleep(backoff_delay(attempt))
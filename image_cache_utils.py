@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from dotenv import load_dotenv
+from download_utils import get_downloader
+from logging_config import logger
+from lru_utils import SQLiteLRU
+
+load_dotenv()
+
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "true").lower() == "true"
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Ask S3 whether a cached image changed (If-None-Match) instead of trusting the cache
+IMAGE_CACHE_REVALIDATE = os.getenv("IMAGE_CACHE_REVALIDATE", "false").lower() == "true"
+
+
+class ImageCache(SQLiteLRU):
+    """
+    Bounded on-disk cache of downloaded source images, keyed by URL.
+
+    Bodies are stored once per SHA-256 of their content, so an image served
+    under several URLs takes space once. Files are written to a temporary name
+    and renamed into place, so a reader never sees a partial image. Reads are
+    memory-mapped and handed to Pillow without copying into the heap. Objects
+    are evicted least-recently-used first once the stored size exceeds max_bytes.
+    Methods block on SQLite and the filesystem; call them from worker threads.
+    """
+
+    name = "Image cache"
+    table = "objects"
+    key_column = "hash"
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0, "bytes_saved": 0}
+        self._stats_lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        super().__init__(os.path.join(directory, "index.sqlite3"), max_bytes)
+
+    def _create_tables(self):
+        self._conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, hash TEXT NOT NULL, etag TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS urls_hash ON urls (hash)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            " hash TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used)")
+
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, "objects", content_hash[:2], content_hash)
+
+    def count(self, **increments):
+        """Add to the hit/miss counters; they are updated from several threads."""
+        with self._stats_lock:
+            for name, value in increments.items():
+                self.stats[name] += value
+
+    def counters(self) -> dict:
+        """Return a snapshot of the hit/miss counters."""
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def get(self, url: str):
+        """Return (memory-mapped body, etag) for a cached URL, or (None, None)."""
+        with self._lock:
+            row = self._conn.execute("SELECT hash, etag FROM urls WHERE url = ?", (url,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE objects SET last_used = ? WHERE hash = ?", (time.time(), row[0]))
+        if row is None:
+            self.count(misses=1)
+            return None, None
+        try:
+            with open(self._path(row[0]), "rb") as file:
+                body = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Removed behind our back (or empty); forget it and download again
+            self._forget(row[0])
+            self.count(misses=1)
+            return None, None
+        self.count(hits=1)
+        return body, row[1]
+
+    def put(self, url: str, body: bytes, etag: str = None):
+        """Store a downloaded body for url, evicting the least recently used objects if over budget."""
+        content_hash = hashlib.sha256(body).hexdigest()
+        path = self._path(content_hash)
+        with self._lock:
+            exists = self._conn.execute("SELECT 1 FROM objects WHERE hash = ?", (content_hash,)).fetchone()
+        if not exists:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    file.write(body)
+                os.replace(temp_path, path)
+            except OSError as e:
+                logger.error(f"Could not write {url} to the image cache: {e}")
+                os.unlink(temp_path)
+                return
+        with self._lock:
+            inserted = self._conn.execute(
+                "INSERT OR IGNORE INTO objects (hash, size, last_used) VALUES (?, ?, ?)",
+                (content_hash, len(body), time.time())
+            ).rowcount
+            self._conn.execute("INSERT OR REPLACE INTO urls (url, hash, etag) VALUES (?, ?, ?)",
+                               (url, content_hash, etag))
+            self._total_bytes += len(body) if inserted else 0
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _forget(self, content_hash: str):
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM objects WHERE hash = ?", (content_hash,)).fetchone()
+            self._drop(content_hash, row[0] if row else 0)
+            self._total_bytes -= row[0] if row else 0
+
+    def _drop(self, content_hash: str, size: int):
+        self._conn.execute("DELETE FROM objects WHERE hash = ?", (content_hash,))
+        self._conn.execute("DELETE FROM urls WHERE hash = ?", (content_hash,))
+        try:
+            # Open memory maps keep their pages until they are closed
+            os.remove(self._path(content_hash))
+        except OSError:
+            pass
+
+    def report(self) -> dict:
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+        return {**self.counters(), "entries": entries, "bytes": self._total_bytes}
+
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+def get_image_cache():
+    """Return the process-wide image cache, or None if caching is disabled."""
+    global _image_cache
+    if not IMAGE_CACHE_ENABLED:
+        return None
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache()
+        return _image_cache
+
+
+def _use_cached(cache: ImageCache, cached, revalidate: bool) -> bool:
+    if cached is None or revalidate:
+        return False
+    cache.count(bytes_saved=len(cached))
+    return True
+
+
+def _not_modified(cache: ImageCache, cached, download) -> bool:
+    if not download.not_modified or cached is None:
+        return False
+    cache.count(not_modified=1, bytes_saved=len(cached))
+    return True
+
+
+def download_image_cached(url: str, revalidate: bool = IMAGE_CACHE_REVALIDATE):
+    """
+    Return the image at url from the cache, downloading (and caching) it on a miss.
+    With revalidate, a cached copy is only used after S3 answers 304 Not Modified.
+    Blocks; cached images are returned as read-only memory maps.
+    """
+    cache = get_image_cache()
+    if cache is None:
+        return get_downloader().fetch(url)
+    cached, etag = cache.get(url)
+    if _use_cached(cache, cached, revalidate):
+        return cached
+    download = get_downloader().submit_conditional(url, etag if cached is not None else None).result()
+    if _not_modified(cache, cached, download):
+        return cached
+    cache.put(url, download.body, download.etag)
+    return download.body
+
+
+async def download_image_cached_async(url: str, revalidate: bool = IMAGE_CACHE_REVALIDATE):
+    """download_image_cached without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    cache = await loop.run_in_executor(None, get_image_cache)
+    if cache is None:
+        return await asyncio.wrap_future(get_downloader().submit(url))
+    # The lookup queries SQLite and maps the file, and may wait for an eviction in progress
+    cached, etag = await loop.run_in_executor(None, cache.get, url)
+    if _use_cached(cache, cached, revalidate):
+        return cached
+    download = await asyncio.wrap_future(
+        get_downloader().submit_conditional(url, etag if cached is not None else None))
+    if _not_modified(cache, cached, download):
+        return cached
+    await loop.run_in_executor(None, cache.put, url, download.body, download.etag)
+    return download.body
@@ -1,8 +1,33 @@
+import contextvars
 import logging
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Id of the image being processed, added to log lines when LOG_TRACE_IDS is set
+trace_id = contextvars.ContextVar("trace_id", default=None)
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the current trace id (or nothing) to every record as %(trace)s."""
+
+    def __init__(self, enabled: bool):
+        super().__init__()
+        self.enabled = enabled
+
+    def filter(self, record):
+        current = trace_id.get() if self.enabled else None
+        record.trace = f" [{current}]" if current else ""
+        return True
+
 
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s - %(message)s"
+    format="%(asctime)s [%(levelname)s] %(name)s%(trace)s - %(message)s"
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdFilter(os.getenv("LOG_TRACE_IDS", "false").lower() == "true"))
 
 logger = logging.getLogger(__name__)
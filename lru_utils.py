@@ -0,0 +1,58 @@
+import sqlite3
+import threading
+
+from logging_config import logger
+
+
+class SQLiteLRU:
+    """
+    Base for persistent caches indexed in SQLite and bounded by size.
+
+    Subclasses set `table` and `key_column` to a table with `size` and
+    `last_used` columns, create their tables in `_create_tables` and delete an
+    entry in `_drop`. Entries are evicted least-recently-used first once the
+    stored size exceeds max_bytes. Database access is serialized by `_lock`.
+    """
+
+    name = "Cache"
+    table = None
+    key_column = None
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        self._total_bytes = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+
+    def _create_tables(self):
+        raise NotImplementedError
+
+    def _drop(self, key: str, size: int):
+        """Delete one entry; called with `_lock` held."""
+        raise NotImplementedError
+
+    def _evict(self):
+        # Trim to 90% of the budget so we don't evict on every insert
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                f"SELECT {self.key_column}, size FROM {self.table} ORDER BY last_used LIMIT 256"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._total_bytes <= target:
+                    break
+                self._drop(key, size)
+                self._total_bytes -= size
+                evicted += 1
+        logger.info(f"{self.name} evicted {evicted} entries ({self._total_bytes} bytes remaining).")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
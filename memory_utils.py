@@ -0,0 +1,113 @@
+import asyncio
+import os
+import resource
+import sys
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Cap on image bytes held across download/prepare/analyze (0 disables the budget)
+MEMORY_BUDGET_BYTES = int(os.getenv("MEMORY_BUDGET_BYTES", str(256 * 1024 * 1024)))
+# Size reserved for a download before its real size is known, until real sizes have been seen
+MEMORY_BUDGET_INITIAL_ESTIMATE = int(os.getenv("MEMORY_BUDGET_INITIAL_ESTIMATE", str(2 * 1024 * 1024)))
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size over the whole life of this process, not reset between runs."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryBudget:
+    """
+    Async budget of image bytes in flight.
+
+    A download reserves an estimate (a running average of real sizes) before
+    it starts, so downloads wait once the budget is used up. The reservation
+    is then resized to what the item actually holds, e.g. shrunk to the
+    prepared payload once the raw bytes are dropped, and released when the
+    item is finished. An item is always admitted when nothing else is in
+    flight, so a single oversized image cannot deadlock the pipeline.
+
+    Working memory needed only during one stage, like a decoded bitmap, is
+    taken with hold(). A hold is admitted when no other hold is active, since
+    every item in flight may already have a reservation.
+    """
+
+    def __init__(self, max_bytes: int = MEMORY_BUDGET_BYTES,
+                 initial_estimate: int = MEMORY_BUDGET_INITIAL_ESTIMATE):
+        self.max_bytes = max_bytes
+        self.estimate = initial_estimate
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0
+        self.holds = 0
+        self._condition = asyncio.Condition()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _fits(self, nbytes: int) -> bool:
+        return not self.enabled or self.in_use == 0 or self.in_use + nbytes <= self.max_bytes
+
+    async def reserve(self) -> int:
+        """Wait for room for one more download and return the number of bytes reserved."""
+        nbytes = int(self.estimate)
+        async with self._condition:
+            if not self._fits(nbytes):
+                self.waits += 1
+                await self._condition.wait_for(lambda: self._fits(nbytes))
+            self._add(nbytes)
+        return nbytes
+
+    async def resize(self, reserved: int, nbytes: int, observed: bool = False) -> int:
+        """
+        Change a reservation to `nbytes` and return it. With `observed`, nbytes is
+        a real download size and updates the estimate for later reservations.
+        """
+        if observed:
+            self.estimate = 0.9 * self.estimate + 0.1 * nbytes
+        async with self._condition:
+            self._add(nbytes - reserved)
+            if nbytes < reserved:
+                self._condition.notify_all()
+        return nbytes
+
+    async def release(self, reserved: int):
+        await self.resize(reserved, 0)
+
+    def _fits_hold(self, nbytes: int) -> bool:
+        return self.holds == 0 or self._fits(nbytes)
+
+    @asynccontextmanager
+    async def hold(self, nbytes: int):
+        """Wait for room for nbytes and keep them reserved while the block runs."""
+        async with self._condition:
+            if not self._fits_hold(nbytes):
+                self.waits += 1
+                await self._condition.wait_for(lambda: self._fits_hold(nbytes))
+            self.holds += 1
+            self._add(nbytes)
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.holds -= 1
+                self._add(-nbytes)
+                self._condition.notify_all()
+
+    def _add(self, nbytes: int):
+        self.in_use += nbytes
+        self.peak = max(self.peak, self.in_use)
+
+    def reset_peak(self):
+        """Start a new measurement period (e.g. one bulk run)."""
+        self.peak = self.in_use
+
+    def report(self) -> dict:
+        return {"peak_bytes_in_flight": self.peak, "budget_waits": self.waits,
+                "lifetime_peak_rss_bytes": peak_rss_bytes()}
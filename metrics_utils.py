@@ -0,0 +1,102 @@
+import os
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily
+
+load_dotenv()
+
+# Port for a standalone metrics server in the worker process (0 disables it)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Stage latencies range from sub-millisecond cache hits to multi-second model calls
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram("auto_review_stage_seconds", "Time spent in each review stage.",
+                          ["stage"], buckets=STAGE_BUCKETS)
+STAGE_IN_FLIGHT = Gauge("auto_review_stage_in_flight", "Operations currently inside each review stage.",
+                        ["stage"])
+RESULTS = Counter("auto_review_results_total", "Review results by category code.", ["category"])
+ERRORS = Counter("auto_review_errors_total", "Review errors by the stage they happened in.", ["stage"])
+QUEUE_DEPTH = Gauge("auto_review_queue_depth", "Items waiting in each worker queue.", ["stage"])
+BYTES_IN_FLIGHT = Gauge("auto_review_bytes_in_flight", "Image bytes currently held by the pipeline.")
+CACHE_ENTRIES = Gauge("auto_review_cache_entries", "Entries stored in each on-disk cache.", ["cache"])
+CACHE_BYTES = Gauge("auto_review_cache_bytes", "Bytes stored in each on-disk cache.", ["cache"])
+RESULT_WRITES_PENDING = Gauge("auto_review_result_writes_pending", "Results buffered for the next bulk write.")
+QUEUE_WAIT = Histogram("auto_review_queue_wait_seconds", "Time claimed images waited before processing started.",
+                       ["priority"], buckets=STAGE_BUCKETS)
+# Labelled per job only while the job has images queued, so the label set stays small
+JOB_QUEUE_WAIT = Gauge("auto_review_job_queue_wait_seconds",
+                       "Wait of the oldest queued image of each job with images waiting.", ["job_id"])
+
+
+# Callbacks receiving every (stage, seconds) sample, e.g. the benchmark's exact percentiles
+_stage_listeners = []
+
+
+def add_stage_listener(callback):
+    _stage_listeners.append(callback)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Time a block as one `stage` span and count it as in flight while it runs."""
+    in_flight = STAGE_IN_FLIGHT.labels(stage)
+    in_flight.inc()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+        in_flight.dec()
+
+
+def observe_stage(stage: str, seconds: float):
+    """Record a stage duration measured elsewhere."""
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    for callback in _stage_listeners:
+        callback(stage, seconds)
+
+
+def count_result(categories: str):
+    """Count a stored verdict once per category code ("T2, W1" counts T2 and W1)."""
+    for code in categories.split(", "):
+        RESULTS.labels(code).inc()
+
+
+def count_error(stage: str):
+    ERRORS.labels(stage).inc()
+
+
+class StatsCollector:
+    """
+    Exposes the plain stats dicts kept by the pipeline components (parse
+    stats, Gemini client, batcher, cascade, cache...) as Prometheus counters
+    read at scrape time, so the components need no metrics code of their own.
+    """
+
+    def __init__(self):
+        self._sources = {}
+
+    def register(self, name: str, source, documentation: str):
+        """`source` is a dict of counters or a callable returning one."""
+        self._sources[name] = (source, documentation)
+
+    def collect(self):
+        for name, (source, documentation) in self._sources.items():
+            values = source() if callable(source) else source
+            family = CounterMetricFamily(f"auto_review_{name}", documentation, labels=["kind"])
+            for kind, value in values.items():
+                family.add_metric([kind], value)
+            yield family
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+def register_stats(name: str, source, documentation: str):
+    """Export a stats dict (or a callable returning one) as the auto_review_<name>_total counter."""
+    stats_collector.register(name, source, documentation)
@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+from dotenv import load_dotenv
+from analysis_utils import prepare_image, PreparedImage, PreprocessPolicy
+from logging_config import logger
+
+load_dotenv()
+
+# Worker processes for image preparation: 0 prepares in the calling thread, "auto" uses the available cores
+PREPARE_PROCESSES = os.getenv("PREPARE_PROCESSES", "0")
+
+
+def available_cores() -> int:
+    """Cores this process may run on (respects CPU affinity, e.g. in containers)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _prepare_shared(name: str, size: int, policy: PreprocessPolicy) -> PreparedImage:
+    """Worker process side: read the image from shared memory and prepare it."""
+    # Spawned workers share the parent's resource tracker, and the parent unlinks the block
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        image_bytes = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    return prepare_image(image_bytes, policy)
+
+
+class PreparePool:
+    """
+    Runs prepare_image in worker processes so decoding and re-encoding are not
+    limited by the GIL. The source bytes are handed over through a shared
+    memory block instead of being pickled; only the (smaller) prepared payload
+    comes back through the pipe.
+    prepare() blocks, so call it from an executor thread like prepare_image.
+    """
+
+    def __init__(self, processes: int = None):
+        self.processes = processes or available_cores()
+        self._lock = threading.Lock()
+        self._pool = self._start()
+        logger.info(f"Image preparation runs in {self.processes} worker processes.")
+
+    def _start(self) -> ProcessPoolExecutor:
+        # spawn: forking a process that runs the downloader and writer threads is not safe
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def prepare(self, image_bytes: bytes, policy: PreprocessPolicy = None) -> PreparedImage:
+        """Prepare an image in a worker process. Raises RuntimeError like prepare_image."""
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(image_bytes)))
+        pool = self._pool
+        try:
+            shm.buf[:len(image_bytes)] = image_bytes
+            return pool.submit(_prepare_shared, shm.name, len(image_bytes), policy).result()
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed for memory); restart the pool and do this one in-thread
+            logger.error(f"Preparation worker process failed, restarting pool: {e}")
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = self._start()
+            return prepare_image(image_bytes, policy)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+_prepare_pool = None
+_prepare_pool_lock = threading.Lock()
+
+def get_prepare_pool():
+    """Return the process-wide preparation pool, or None to prepare in-thread."""
+    global _prepare_pool
+    if PREPARE_PROCESSES in ("", "0"):
+        return None
+    with _prepare_pool_lock:
+        if _prepare_pool is None:
+            _prepare_pool = PreparePool(None if PREPARE_PROCESSES == "auto" else int(PREPARE_PROCESSES))
+        return _prepare_pool
@@ -0,0 +1,210 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+from dotenv import load_dotenv
+from logging_config import logger
+
+load_dotenv()
+
+# off: call the model, record: call the model and store every response, replay: serve stored responses only
+GEMINI_REPLAY_MODE = os.getenv("GEMINI_REPLAY_MODE", "off").lower()
+GEMINI_REPLAY_PATH = os.getenv("GEMINI_REPLAY_PATH", "gemini_responses.jsonl")
+
+
+def _sha256(data) -> str:
+    return hashlib.sha256(data.encode() if isinstance(data, str) else data).hexdigest()
+
+
+def request_fingerprint(contents: list, model_name: str, kwargs: dict) -> dict:
+    """
+    Identify a model request by its model, prompt, images and generation settings.
+    Returns the fingerprint fields; `key` combines all of them.
+    """
+    texts, images = [], []
+    for part in contents:
+        if isinstance(part, str):
+            texts.append(part)
+        else:
+            images.append(_sha256(part["data"]))
+    settings = json.dumps(kwargs, sort_keys=True, default=str)
+    fingerprint = {
+        "model": model_name,
+        "prompt_hash": _sha256(texts[0]) if texts else "",
+        "text_hash": _sha256("\x00".join(texts)),
+        "image_hashes": images,
+        "settings_hash": _sha256(settings),
+    }
+    fingerprint["key"] = _sha256(json.dumps(fingerprint, sort_keys=True))
+    return fingerprint
+
+
+class ReplayedResponse:
+    """Stands in for a GenerateContentResponse; only the text is stored."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.usage_metadata = None
+
+
+class ReplayMiss(RuntimeError):
+    """No recorded response matches the request."""
+
+
+class ResponseStore:
+    """
+    Append-only JSONL store of model responses keyed by request fingerprint.
+    Each line holds the fingerprint, the raw response text and when it was
+    recorded. When a key is recorded more than once, the latest wins.
+    """
+
+    def __init__(self, path: str = GEMINI_REPLAY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._texts = {}
+        if os.path.exists(path):
+            for record in self.records():
+                self._texts[record["key"]] = record["text"]
+
+    def records(self):
+        """Iterate over every stored record in recording order."""
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+    def get(self, key: str):
+        return self._texts.get(key)
+
+    def append(self, fingerprint: dict, text: str):
+        record = {**fingerprint, "text": text, "recorded_at": time.time()}
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line)
+            self._texts[fingerprint["key"]] = text
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+
+class ReplayModel:
+    """
+    Wraps a model client (normally GeminiClient) to record or replay responses.
+    Exposes the same generate_content / generate_content_async interface, so it
+    can be used anywhere a genai_model is expected. In replay mode the wrapped
+    client is never called and a request without a recording raises ReplayMiss.
+    """
+
+    def __init__(self, client, store: ResponseStore, mode: str):
+        self.client = client
+        self.store = store
+        self.mode = mode
+        self.model_name = client.model_name
+        self.replay_stats = {"recorded": 0, "replayed": 0, "misses": 0}
+
+    @property
+    def stats(self) -> dict:
+        return self.client.stats
+
+    def _replay(self, fingerprint: dict) -> ReplayedResponse:
+        text = self.store.get(fingerprint["key"])
+        if text is None:
+            self.replay_stats["misses"] += 1
+            raise ReplayMiss(f"No recorded response for request {fingerprint['key'][:12]}")
+        self.replay_stats["replayed"] += 1
+        return ReplayedResponse(text)
+
+    def _record(self, fingerprint: dict, response):
+        try:
+            text = response.text
+        except ValueError:
+            # Blocked/empty responses have no text to replay
+            return
+        self.store.append(fingerprint, text)
+        self.replay_stats["recorded"] += 1
+
+    async def generate_content_async(self, contents: list, **kwargs):
+        fingerprint = request_fingerprint(contents, self.model_name, kwargs)
+        if self.mode == "replay":
+            return self._replay(fingerprint)
+        response = await self.client.generate_content_async(contents=contents, **kwargs)
+        self._record(fingerprint, response)
+        return response
+
+    def generate_content(self, contents: list, **kwargs):
+        fingerprint = request_fingerprint(contents, self.model_name, kwargs)
+        if self.mode == "replay":
+            return self._replay(fingerprint)
+        response = self.client.generate_content(contents=contents, **kwargs)
+        self._record(fingerprint, response)
+        return response
+
+
+_stores = {}
+
+def with_replay(client, mode: str = GEMINI_REPLAY_MODE, path: str = GEMINI_REPLAY_PATH):
+    """Wrap `client` for recording or replay according to GEMINI_REPLAY_MODE; returns it unchanged when off."""
+    if mode not in ("record", "replay"):
+        return client
+    # Models sharing a file share one store, so appends never interleave
+    if path not in _stores:
+        _stores[path] = ResponseStore(path)
+        logger.info(f"Gemini responses {mode} mode using {path} ({len(_stores[path])} stored).")
+    return ReplayModel(client, _stores[path], mode)
+
+
+def reparse(path: str, out: str = None) -> dict:
+    """
+    Re-run response parsing and category mapping over every recorded analysis.
+    Returns summary counts; with `out`, writes one JSON line per image with its verdict.
+    """
+    from analysis_utils import (ANALYSIS_PROMPT, AnalysisParseError, BATCH_ANALYSIS_PROMPT, SCREEN_PROMPT,
+                                categorize_analysis, clean_json_response, parse_batch_response)
+
+    single_prompts = {_sha256(ANALYSIS_PROMPT), _sha256(SCREEN_PROMPT)}
+    categories, summary = Counter(), Counter()
+    output = open(out, "w", encoding="utf-8") if out else None
+    start = time.perf_counter()
+    try:
+        for record in ResponseStore(path).records():
+            images = record["image_hashes"]
+            if record["prompt_hash"] in single_prompts and len(images) == 1:
+                try:
+                    verdicts = [categorize_analysis(clean_json_response(record["text"]))]
+                except AnalysisParseError:
+                    verdicts = [None]
+            elif len(images) > 1 and record["prompt_hash"] == _sha256(BATCH_ANALYSIS_PROMPT.format(count=len(images))):
+                verdicts = parse_batch_response(record["text"], len(images))
+            else:
+                # Key checks, repair requests and other text-only calls
+                summary["skipped"] += 1
+                continue
+
+            for image_hash, verdict in zip(images, verdicts):
+                summary["images"] += 1
+                if verdict is None:
+                    summary["parse_failures"] += 1
+                    continue
+                for code in verdict[0].split(", "):
+                    categories[code] += 1
+                if output:
+                    output.write(json.dumps({"image_hash": image_hash, "model": record["model"],
+                                             "categories": verdict[0], "details": verdict[1]}) + "\n")
+    finally:
+        if output:
+            output.close()
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return {"summary": dict(summary), "categories": dict(categories.most_common())}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-run parsing and category mapping over recorded responses.")
+    parser.add_argument("--path", default=GEMINI_REPLAY_PATH, help="recorded responses (JSONL)")
+    parser.add_argument("--out", help="write one verdict per image to this JSONL file, e.g. to diff two runs")
+    args = parser.parse_args()
+    print(json.dumps(reparse(args.path, args.out), indent=2))
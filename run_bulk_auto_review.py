@@ -1,33 +1,19 @@
-from fastapi.testclient import TestClient
-from app import app
+from worker import ReviewWorker
+from app import executor, genai_model, memory_budget, validate_gemini_api_key
+from analysis_utils import PRESCREEN_ENABLED, prescreen_report
+from metrics_utils import METRICS_PORT
+from prometheus_client import start_http_server
+from fastapi import HTTPException
 from tqdm import tqdm
-from datetime import datetime, timedelta
+from datetime import timedelta
+import argparse
+import asyncio
+import json
+import requests
 import time
-import keyboard
 import signal
 import sys
 
-# Initialize the TestClient with the FastAPI app
-client = TestClient(app)
-
-# Global flag to track if termination is requested
-termination_requested = False
-
-def signal_handler(sig, frame):
-    """Handle Ctrl+C signal"""
-    global termination_requested
-    if not termination_requested:
-        print("\nGraceful termination requested. Completing current batch before exiting...")
-        termination_requested = True
-    else:
-        print("\nForced exit. Terminating immediately.")
-        sys.exit(0)
-
-def run_bulk_auto_review():
-    """Run a single batch of auto review"""
-    response = client.post("/bulk_auto_review")
-    return response.json()
-
 def print_summary(success_count, error_count, start_time):
     """Print a summary of the processing statistics"""
     total_count = success_count + error_count
@@ -42,44 +28,111 @@ def print_summary(success_count, error_count, start_time):
     print(f"Failed: {error_count} ({error_count/total_count*100:.1f}% of total)" if total_count > 0 else "Failed: 0 (0.0% of total)")
     print(f"Time elapsed: {elapsed_formatted}")
     print(f"Average processing time: {elapsed_time/total_count:.2f} seconds per image" if total_count > 0 else "Average processing time: N/A")
+    if PRESCREEN_ENABLED:
+        print(prescreen_report())
     print("=" * 50)
 
+def install_signal_handlers(worker: ReviewWorker):
+    """First Ctrl+C/SIGTERM stops claiming and drains; a second one exits immediately."""
+    loop = asyncio.get_running_loop()
+
+    def handle_stop():
+        if not worker.stopping:
+            print("\nGraceful termination requested. Finishing claimed images before exiting...")
+            worker.stop()
+        else:
+            print("\nForced exit. Terminating immediately.")
+            sys.exit(0)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, handle_stop)
+        except (NotImplementedError, AttributeError, ValueError):
+            # Windows: no loop signal handlers, fall back to signal.signal
+            signal.signal(sig, lambda s, f: loop.call_soon_threadsafe(handle_stop))
+
+async def run_worker(pbar: tqdm) -> ReviewWorker:
+    """Run the streaming worker until it is asked to stop."""
+    worker = ReviewWorker(on_result=lambda item: pbar.update(1))
+    install_signal_handlers(worker)
+    await worker.run()
+    return worker
+
+def run_remote(server: str, pbar: tqdm, counts: dict, idle_delay: float = 5.0):
+    """
+    Drive a running server instead of an in-process worker: call its streaming
+    /bulk_auto_review repeatedly and count each result as it arrives.
+    """
+    stop_requested = []
+
+    def handle_stop(signum, frame):
+        if not stop_requested:
+            print("\nGraceful termination requested. Finishing the current batch before exiting...")
+            stop_requested.append(signum)
+        else:
+            print("\nForced exit. Terminating immediately.")
+            sys.exit(0)
+
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGTERM, handle_stop)
+
+    while not stop_requested:
+        processed = 0
+        with requests.post(f"{server.rstrip('/')}/bulk_auto_review", params={"stream": "ndjson"},
+                           stream=True, timeout=(10, None)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                message = json.loads(line)
+                if message["event"] == "result":
+                    processed += 1
+                    counts[message["status"]] += 1
+                    pbar.update(1)
+                    pbar.set_postfix(success=counts["success"], errors=counts["error"])
+                elif message["event"] == "done" and not message.get("processed"):
+                    pbar.write(message["message"])
+        if not processed:
+            time.sleep(idle_delay)
+
 if __name__ == "__main__":
-    # Register signal handler for Ctrl+C
-    signal.signal(signal.SIGINT, signal_handler)
-    
-    # Initialize counters and timer
-    success_count = 0
-    error_count = 0
+    parser = argparse.ArgumentParser(description="Run the auto review worker.")
+    parser.add_argument("--server", help="stream results from a running app at this URL instead of "
+                                         "running the worker in this process, e.g. http://localhost:8000")
+    args = parser.parse_args()
+
+    if args.server:
+        counts = {"success": 0, "error": 0}
+        start_time = time.time()
+        print(f"Streaming auto review results from {args.server}. Press Ctrl+C to stop after the current batch.")
+        with tqdm(desc="Images reviewed", unit="img") as pbar:
+            run_remote(args.server, pbar, counts)
+        print_summary(counts["success"], counts["error"], start_time)
+        sys.exit(0)
+
+    # Check the API key once up front instead of before every batch
+    try:
+        validate_gemini_api_key(genai_model)
+    except HTTPException as e:
+        print(e.detail)
+        sys.exit(1)
+
+    # The worker has no FastAPI app, so serve /metrics on its own port if asked
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        print(f"Serving metrics on port {METRICS_PORT}.")
+
     start_time = time.time()
-    batch_count = 0
-    
-    print("Starting bulk auto review process. Press Ctrl+C to gracefully terminate.")
-    
-    with tqdm(desc="Running bulk_auto_review") as pbar:
-        while not termination_requested:
-            # Run a batch of auto review
-            result = run_bulk_auto_review()
-            batch_count += 1
-            
-            # Process results and update statistics
-            if "results" in result:
-                for item in result["results"]:
-                    if isinstance(item, dict) and "status" in item:
-                        if item["status"] == "success":
-                            success_count += 1
-                        else:  # status is "error"
-                            error_count += 1
-            
-            # Update progress bar
-            pbar.update(1)
-            
-            # Check if user pressed 'q' to quit
-            if keyboard.is_pressed('q'):
-                print("\nGraceful termination requested. Completing current batch before exiting...")
-                termination_requested = True
-    
+    print("Starting auto review worker. Press Ctrl+C (or send SIGTERM) to gracefully terminate.")
+
+    with tqdm(desc="Images reviewed", unit="img") as pbar:
+        worker = asyncio.run(run_worker(pbar))
+
     # Print final summary
-    print_summary(success_count, error_count, start_time)
-    print(f"Total batches processed: {batch_count}")
-    print("Bulk auto review process completed.")
+    print_summary(worker.success_count, worker.error_count, start_time)
+    memory = memory_budget.report()
+    print(f"Peak image bytes in flight: {memory['peak_bytes_in_flight'] / 1e6:.1f} MB "
+          f"(budget waits: {memory['budget_waits']}), "
+          f"process lifetime peak RSS: {memory['lifetime_peak_rss_bytes'] / 1e6:.1f} MB")
+    print("Auto review worker stopped.")
+    executor.shutdown(wait=False)
@@ -0,0 +1,125 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+from metrics_utils import JOB_QUEUE_WAIT, QUEUE_WAIT
+
+load_dotenv()
+
+# Deadlines further away than this (seconds) do not affect the order yet; matches the claim function
+SCHEDULER_DEADLINE_HORIZON = float(os.getenv("SCHEDULER_DEADLINE_HORIZON", "300"))
+
+
+def record_priority(record: dict) -> int:
+    """review_priority of a claimed row; higher is more urgent."""
+    return record.get("review_priority") or 0
+
+
+def record_deadline(record: dict) -> float:
+    """review_deadline of a claimed row as a Unix timestamp, or inf if it has none."""
+    deadline = record.get("review_deadline")
+    if not deadline:
+        return math.inf
+    try:
+        return datetime.fromisoformat(deadline).timestamp()
+    except (TypeError, ValueError):
+        return math.inf
+
+
+def priority_class(record: dict) -> str:
+    return "urgent" if record_priority(record) > 0 else "normal"
+
+
+class FairSchedule:
+    """
+    Claimed rows waiting to be processed, handed out fairly across jobs.
+
+    pop() returns the most urgent row: highest review_priority first, then the
+    earliest review_deadline among deadlines within SCHEDULER_DEADLINE_HORIZON,
+    then round-robin over job_id (the job served longest ago goes next), and
+    arrival order within a job. Deadlines count only if they are within the
+    horizon when the row is queued, both across and within jobs, like the
+    claim function. A job with thousands of rows queued therefore gets one
+    turn per round like a job with one. With export_waits, each job with
+    queued rows exports its oldest wait as a gauge.
+    """
+
+    def __init__(self, deadline_horizon: float = SCHEDULER_DEADLINE_HORIZON, export_waits: bool = False):
+        self.deadline_horizon = deadline_horizon
+        self.export_waits = export_waits
+        self._jobs = {}
+        self._last_served = {}
+        self._rounds = itertools.count()
+        self._arrivals = itertools.count()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, record: dict):
+        job_id = record["job_id"]
+        queued = self._jobs.get(job_id)
+        if queued is None:
+            queued = self._jobs[job_id] = []
+            if self.export_waits:
+                JOB_QUEUE_WAIT.labels(job_id).set_function(lambda: self.oldest_wait(job_id))
+        deadline = record_deadline(record)
+        due_by = deadline if deadline <= time.time() + self.deadline_horizon else math.inf
+        heapq.heappush(queued, (-record_priority(record), due_by, next(self._arrivals), time.monotonic(), record))
+        self._size += 1
+
+    def pop(self) -> (dict, float):
+        """Remove the next row to process. Returns it with the seconds it waited."""
+        job_id = min(self._jobs, key=self._order)
+        queued = self._jobs[job_id]
+        _, _, _, enqueued, record = heapq.heappop(queued)
+        if queued:
+            self._last_served[job_id] = next(self._rounds)
+        else:
+            # A job that comes back later starts a fresh turn, like a new job
+            del self._jobs[job_id]
+            self._last_served.pop(job_id, None)
+            if self.export_waits:
+                JOB_QUEUE_WAIT.remove(job_id)
+        self._size -= 1
+        return record, time.monotonic() - enqueued
+
+    def _order(self, job_id: str) -> tuple:
+        negative_priority, due_by, arrival, _, _ = self._jobs[job_id][0]
+        return negative_priority, due_by, self._last_served.get(job_id, -1), arrival
+
+    def oldest_wait(self, job_id: str) -> float:
+        """Seconds the longest-waiting queued row of the job has waited (0 if none)."""
+        queued = self._jobs.get(job_id)
+        return time.monotonic() - min(entry[3] for entry in queued) if queued else 0.0
+
+
+def fair_order(records: list) -> list:
+    """Return claimed rows in the order FairSchedule would process them."""
+    schedule = FairSchedule()
+    for record in records:
+        schedule.push(record)
+    return [schedule.pop()[0] for _ in records]
+
+
+class FairQueue(asyncio.Queue):
+    """
+    asyncio.Queue of claimed rows that hands them out in FairSchedule order
+    instead of FIFO, and records how long each row waited in the queue.
+    """
+
+    def _init(self, maxsize):
+        self._queue = FairSchedule(export_waits=True)
+
+    def _put(self, record: dict):
+        self._queue.push(record)
+
+    def _get(self) -> dict:
+        record, waited = self._queue.pop()
+        QUEUE_WAIT.labels(priority_class(record)).observe(waited)
+        return record
@@ -0,0 +1,87 @@
+-- Lease-based work claiming for midbot_images.
+-- Apply once in the Supabase SQL editor. Workers claim rows through
+-- claim_midbot_images, renew them with renew_midbot_image_leases while
+-- processing, and reap_midbot_image_leases returns abandoned rows.
+
+alter table midbot_images
+    add column if not exists lease_owner text,
+    add column if not exists lease_expires_at timestamptz;
+
+create index if not exists midbot_images_review_status_created_at
+    on midbot_images (review_status, created_at);
+
+create index if not exists midbot_images_processing_lease
+    on midbot_images (lease_expires_at)
+    where review_status = 'processing';
+
+-- Atomically move up to p_limit rows from p_status to 'processing' and lease them to p_owner.
+-- SKIP LOCKED lets concurrent workers claim disjoint rows without blocking each other.
+create or replace function claim_midbot_images(
+    p_status text,
+    p_limit integer,
+    p_owner text,
+    p_lease_seconds integer
+)
+returns setof midbot_images
+language sql
+as $$
+    update midbot_images m
+    set review_status = 'processing',
+        updated_at = now(),
+        lease_owner = p_owner,
+        lease_expires_at = now() + make_interval(secs => p_lease_seconds)
+    where m.id in (
+        select id
+        from midbot_images
+        where review_status = p_status
+        order by created_at
+        limit p_limit
+        for update skip locked
+    )
+    returning m.*;
+$$;
+
+-- Extend the leases p_owner still holds. Returns the number of rows renewed.
+create or replace function renew_midbot_image_leases(
+    p_ids uuid[],
+    p_owner text,
+    p_lease_seconds integer
+)
+returns integer
+language sql
+as $$
+    with renewed as (
+        update midbot_images
+        set lease_expires_at = now() + make_interval(secs => p_lease_seconds)
+        where id = any(p_ids)
+          and lease_owner = p_owner
+          and review_status = 'processing'
+        returning 1
+    )
+    select count(*)::integer from renewed;
+$$;
+
+-- Return expired leases to p_status. Rows stuck in 'processing' from before
+-- leases existed (no lease_expires_at) are reaped once updated_at is older
+-- than p_stale_seconds. Returns the number of rows reaped.
+create or replace function reap_midbot_image_leases(
+    p_status text default 'downloaded',
+    p_stale_seconds integer default 3600
+)
+returns integer
+language sql
+as $$
+    with reaped as (
+        update midbot_images
+        set review_status = p_status,
+            lease_owner = null,
+            lease_expires_at = null
+        where review_status = 'processing'
+          and (
+              lease_expires_at < now()
+              or (lease_expires_at is null and updated_at < now() - make_interval(secs => p_stale_seconds))
+          )
+        returning 1
+    )
+    select count(*)::integer from reaped;
+$$;
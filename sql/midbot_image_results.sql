@@ -0,0 +1,28 @@
+-- Bulk write-back of auto review results.
+-- Apply once in the Supabase SQL editor. p_rows is a JSON array of
+-- {"id", "auto_review_status", "review_status", "auto_review_details"}
+-- objects; each matching row is updated and its lease released.
+-- Returns the number of rows updated.
+
+create or replace function update_midbot_image_results(p_rows jsonb)
+returns integer
+language sql
+as $$
+    with updated as (
+        update midbot_images m
+        set auto_review_status = r.auto_review_status,
+            review_status = r.review_status,
+            auto_review_details = r.auto_review_details,
+            lease_owner = null,
+            lease_expires_at = null
+        from jsonb_to_recordset(p_rows) as r(
+            id uuid,
+            auto_review_status text,
+            review_status text,
+            auto_review_details text
+        )
+        where m.id = r.id
+        returning 1
+    )
+    select count(*)::integer from updated;
+$$;
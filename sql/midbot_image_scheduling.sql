@@ -0,0 +1,113 @@
+-- Fair, priority-aware claiming for midbot_images.
+-- Apply once in the Supabase SQL editor after midbot_image_leases.sql; it
+-- replaces claim_midbot_images with the same signature. Rows are handed out
+-- by review_priority (higher first), then by review_deadline once it is less
+-- than 5 minutes away (earliest first), then round-robin across job_id with
+-- the oldest rows of each job first. One large job therefore cannot starve the
+-- others, and urgent re-reviews skip the backlog:
+--
+--     update midbot_images
+--     set review_status = 'downloaded', review_priority = 10
+--     where job_id = '...';
+
+alter table midbot_images
+    add column if not exists review_priority integer not null default 0,
+    add column if not exists review_deadline timestamptz;
+
+create index if not exists midbot_images_review_status_job
+    on midbot_images (review_status, job_id, review_priority desc, created_at);
+
+-- Finds the jobs with an urgent deadline without scanning the backlog
+create index if not exists midbot_images_review_deadline
+    on midbot_images (review_status, review_deadline)
+    where review_deadline is not null;
+
+create or replace function claim_midbot_images(
+    p_status text,
+    p_limit integer,
+    p_owner text,
+    p_lease_seconds integer
+)
+returns setof midbot_images
+language sql
+as $$
+    with recursive job_ids as (
+        -- Distinct job_ids by skipping through midbot_images_review_status_job,
+        -- one index probe per job instead of reading every waiting row
+        (select job_id
+         from midbot_images
+         where review_status = p_status
+         order by job_id
+         limit 1)
+        union all
+        select (select m.job_id
+                from midbot_images m
+                where m.review_status = p_status
+                  and m.job_id > j.job_id
+                order by m.job_id
+                limit 1)
+        from job_ids j
+        where j.job_id is not null
+    ),
+    jobs as (
+        -- At most p_limit rows are handed out, so only the p_limit jobs whose
+        -- next row comes first are needed, plus any job with an urgent deadline
+        (select j.job_id
+         from job_ids j
+         cross join lateral (
+             select review_priority, created_at
+             from midbot_images
+             where review_status = p_status
+               and job_id = j.job_id
+             order by review_priority desc, created_at
+             limit 1
+         ) h
+         where j.job_id is not null
+         order by h.review_priority desc, h.created_at
+         limit p_limit)
+        union
+        (select job_id
+         from midbot_images
+         where review_status = p_status
+           and review_deadline < now() + interval '5 minutes'
+         order by review_deadline
+         limit p_limit)
+    ),
+    candidates as (
+        -- No job can contribute more than p_limit rows, so only those are ranked.
+        -- Nothing is locked here; concurrent claims rank the same rows and lock
+        -- different ones below.
+        select c.*,
+               row_number() over (partition by c.job_id
+                                  order by c.review_priority desc, c.due_by nulls last, c.created_at) as job_rank
+        from jobs j
+        cross join lateral (
+            select id, job_id, review_priority, created_at,
+                   case when review_deadline < now() + interval '5 minutes' then review_deadline end as due_by
+            from midbot_images
+            where review_status = p_status
+              and job_id = j.job_id
+            order by review_priority desc, due_by nulls last, created_at
+            limit p_limit
+        ) c
+    ),
+    picked as (
+        -- Only the rows handed out are locked; rows another claim holds are
+        -- skipped and the next ranked ones taken instead
+        select m.id
+        from candidates c
+        join midbot_images m on m.id = c.id
+        where m.review_status = p_status
+        order by c.review_priority desc, c.due_by nulls last, c.job_rank, c.created_at
+        limit p_limit
+        for update of m skip locked
+    )
+    update midbot_images m
+    set review_status = 'processing',
+        updated_at = now(),
+        lease_owner = p_owner,
+        lease_expires_at = now() + make_interval(secs => p_lease_seconds)
+    from picked
+    where m.id = picked.id
+    returning m.*;
+$$;
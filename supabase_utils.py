@@ -1,58 +1,113 @@
+import atexit
 import os
+import socket
+import threading
 from dotenv import load_dotenv
-from supabase import create_client, Client
 from logging_config import logger
-from datetime import datetime, timezone
+from metrics_utils import stage_timer, count_error
 
 load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
-image_limit = int(os.getenv("LIMIT"))
+image_limit = int(os.getenv("LIMIT", "50"))
 
-if not SUPABASE_URL or not SUPABASE_ANON_KEY:
-    raise EnvironmentError("Missing SUPABASE_URL or SUPABASE_ANON_KEY in .env file.")
+# Identifies this worker's leases; must be unique per running process
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# How long a claimed row stays leased without a heartbeat
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "300"))
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+# Write-behind settings for auto review results
+RESULT_FLUSH_SIZE = int(os.getenv("RESULT_FLUSH_SIZE", "50"))
+RESULT_FLUSH_INTERVAL = float(os.getenv("RESULT_FLUSH_INTERVAL", "2"))
+RESULT_FLUSH_MAX_ATTEMPTS = int(os.getenv("RESULT_FLUSH_MAX_ATTEMPTS", "5"))
+
+_supabase = None
+_supabase_lock = threading.Lock()
+
+def get_supabase():
+    """Return the shared Supabase client, creating it (and importing the SDK) on first use."""
+    global _supabase
+    with _supabase_lock:
+        if _supabase is None:
+            if not SUPABASE_URL or not SUPABASE_ANON_KEY:
+                raise EnvironmentError("Missing SUPABASE_URL or SUPABASE_ANON_KEY in .env file.")
+            from supabase import create_client
+
+            _supabase = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+        return _supabase
 
 def get_image_record_by_id(image_id: str):
     """Fetch a single image record by id."""
     logger.info(f"Fetching record by id: {image_id}")
-    response = supabase.table("midbot_images").select("*").eq("id", image_id).execute()
+    response = get_supabase().table("midbot_images").select("*").eq("id", image_id).execute()
     data = response.data
     if data:
         return data[0]
     return None
 
 
-def get_images_with_status(status: str):
-    """Fetch all images with the given review_status and update them to 'processing' with updated_at timestamp."""
-    logger.info(f"Fetching images with review_status={status}")
-
-    # Step 1: Fetch images with the given status
-    response = supabase.table("midbot_images").select("*").order("created_at").limit(image_limit).eq("review_status", status).execute()
-    images = response.data
+def claim_images(status: str, limit: int = None, owner: str = WORKER_ID, lease_seconds: int = LEASE_SECONDS):
+    """
+    Atomically move up to `limit` images with the given review_status to 'processing'
+    and lease them to `owner`. Concurrent workers never receive the same rows.
+    """
+    limit = limit or image_limit
+    logger.info(f"Claiming up to {limit} images with review_status={status} for {owner}")
+    response = get_supabase().rpc("claim_midbot_images", {
+        "p_status": status,
+        "p_limit": limit,
+        "p_owner": owner,
+        "p_lease_seconds": lease_seconds
+    }).execute()
+    images = response.data or []
+    logger.info(f"Claimed {len(images)} images with a {lease_seconds}s lease.")
+    return images
+
+
+def get_image_record_by_job(job_id: str, image_index: int):
+    """Fetch a single image record by job_id and image_index."""
+    response = (
+        get_supabase().table("midbot_images").select("*")
+        .eq("job_id", job_id).eq("image_index", image_index)
+        .limit(1).execute()
+    )
+    data = response.data
+    if data:
+        return data[0]
+    return None
 
-    if not images:
-        return []
 
-    # Extract the IDs of the fetched images
-    image_ids = [image["id"] for image in images]
+def get_images_with_status(status: str):
+    """
+    Claim images with the given review_status, marking them 'processing' under a lease.
+    claim_midbot_images hands them out by priority, then round-robin across jobs.
+    """
+    return claim_images(status)
 
-    # Get the current time in UTC
-    current_utc_time = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
 
-    # Step 2: Update the review_status to 'processing' and set updated_at timestamp
-    update_response = supabase.table("midbot_images").update({
-        "review_status": "processing",
-        "updated_at": current_utc_time
-    }).in_("id", image_ids).execute()
+def renew_leases(image_ids: list, owner: str = WORKER_ID, lease_seconds: int = LEASE_SECONDS) -> int:
+    """Extend the leases `owner` still holds on the given images. Returns the number renewed."""
+    if not image_ids:
+        return 0
+    response = get_supabase().rpc("renew_midbot_image_leases", {
+        "p_ids": image_ids,
+        "p_owner": owner,
+        "p_lease_seconds": lease_seconds
+    }).execute()
+    renewed = response.data or 0
+    if renewed < len(image_ids):
+        logger.warning(f"Renewed {renewed} of {len(image_ids)} leases; the rest finished or were reaped.")
+    return renewed
 
-    # Extract updated images from the response
-    updated_images = update_response.data
 
-    logger.info(f"Updated {len(image_ids)} images to 'processing' status with updated_at={current_utc_time}.")
-    return updated_images
+def reap_expired_leases(status: str = "downloaded") -> int:
+    """Return images whose lease expired (crashed or stalled workers) to `status`."""
+    response = get_supabase().rpc("reap_midbot_image_leases", {"p_status": status}).execute()
+    reaped = response.data or 0
+    if reaped:
+        logger.warning(f"Reaped {reaped} expired leases back to review_status={status}.")
+    return reaped
 
 
 def update_auto_review_results(image_id: str, auto_review_status: str, review_status: str, auto_review_details: str):
@@ -64,13 +119,130 @@ def update_auto_review_results(image_id: str, auto_review_status: str, review_st
     """
     logger.info(f"Updating auto_review_status for {image_id} = {auto_review_status}")
     response = (
-        supabase.table("midbot_images")
+        get_supabase().table("midbot_images")
         .update({
             "auto_review_status": auto_review_status,
             "review_status": review_status,
-            "auto_review_details": auto_review_details
+            "auto_review_details": auto_review_details,
+            "lease_owner": None,
+            "lease_expires_at": None
         })
         .eq("id", image_id)
         .execute()
     )
     return response.data
+
+
+def update_auto_review_results_bulk(rows: list) -> int:
+    """
+    Write many auto review results in one round-trip.
+    Each row has id, auto_review_status, review_status and auto_review_details.
+    """
+    response = get_supabase().rpc("update_midbot_image_results", {"p_rows": rows}).execute()
+    return response.data or 0
+
+
+class ResultWriter:
+    """
+    Write-behind buffer for auto review results.
+    Results are collected and flushed with update_auto_review_results_bulk when
+    `flush_size` rows are waiting or every `flush_interval` seconds. Failed rows
+    are retried on the next flush; after `max_attempts` they are written one by one. close()
+    flushes everything that is still buffered.
+    """
+
+    def __init__(self, flush_size: int = RESULT_FLUSH_SIZE, flush_interval: float = RESULT_FLUSH_INTERVAL,
+                 max_attempts: int = RESULT_FLUSH_MAX_ATTEMPTS):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._rows = {}
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, image_id: str, auto_review_status: str, review_status: str, auto_review_details: str):
+        """Buffer a result. A later result for the same image replaces an unflushed one."""
+        with self._lock:
+            self._rows[image_id] = {
+                "id": image_id,
+                "auto_review_status": auto_review_status,
+                "review_status": review_status,
+                "auto_review_details": auto_review_details
+            }
+            if len(self._rows) >= self.flush_size:
+                self._wakeup.set()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._rows)
+
+    def flush(self):
+        """Write all buffered rows now."""
+        with self._lock:
+            rows, self._rows = list(self._rows.values()), {}
+        for start in range(0, len(rows), self.flush_size):
+            self._write(rows[start:start + self.flush_size])
+
+    def _write(self, rows: list):
+        try:
+            with stage_timer("db_write"):
+                update_auto_review_results_bulk(rows)
+            logger.info(f"Flushed {len(rows)} auto review results.")
+            for row in rows:
+                self._attempts.pop(row["id"], None)
+            return
+        except Exception as e:
+            logger.error(f"Bulk result write of {len(rows)} rows failed: {e}")
+
+        for row in rows:
+            attempts = self._attempts.get(row["id"], 0) + 1
+            if attempts < self.max_attempts and not self._closed:
+                self._attempts[row["id"]] = attempts
+                with self._lock:
+                    self._rows.setdefault(row["id"], row)
+                continue
+
+            # Out of bulk attempts: fall back to single-row updates
+            self._attempts.pop(row["id"], None)
+            try:
+                update_auto_review_results(
+                    image_id=row["id"],
+                    auto_review_status=row["auto_review_status"],
+                    review_status=row["review_status"],
+                    auto_review_details=row["auto_review_details"]
+                )
+            except Exception as e:
+                logger.error(f"Dropping auto review result for {row['id']} after {attempts} attempts: {e}")
+                count_error("db_write")
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the background flusher and write everything still buffered."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+
+_result_writer = None
+_result_writer_lock = threading.Lock()
+
+def get_result_writer() -> ResultWriter:
+    """Return the process-wide result writer, creating it on first use."""
+    global _result_writer
+    with _result_writer_lock:
+        if _result_writer is None:
+            _result_writer = ResultWriter()
+            atexit.register(_result_writer.close)
+        return _result_writer
@@ -0,0 +1,78 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
+from analysis_utils import EXIF_ORIENTATION, PreprocessPolicy, image_stats, prepare_image
+
+POLICIES = [PreprocessPolicy("test-jpeg", max_edge=64, output_format="JPEG", quality=90),
+            PreprocessPolicy("test-webp", max_edge=64, output_format="WEBP", quality=90)]
+
+
+def encode(img: Image.Image, format_: str, **params) -> bytes:
+    with io.BytesIO() as output:
+        img.save(output, format=format_, **params)
+        return output.getvalue()
+
+
+def sent_pixels(image_bytes: bytes, policy: PreprocessPolicy) -> np.ndarray:
+    prepared = prepare_image(image_bytes, policy)
+    with Image.open(io.BytesIO(prepared.data)) as sent:
+        return np.asarray(sent.convert("RGB"), dtype=np.int16)
+
+
+@pytest.fixture
+def png_16bit() -> bytes:
+    """Horizontal grey ramp over the full 16-bit range."""
+    ramp = np.tile(np.linspace(0, 65535, 256), (128, 1)).astype(np.uint16)
+    return encode(Image.fromarray(ramp), "PNG")
+
+
+@pytest.fixture
+def png_rgba() -> bytes:
+    """Red square on a fully transparent background."""
+    img = Image.new("RGBA", (256, 256), (0, 0, 0, 0))
+    img.paste((255, 0, 0, 255), (64, 64, 192, 192))
+    return encode(img, "PNG")
+
+
+@pytest.fixture
+def jpeg_rotated() -> bytes:
+    """Landscape JPEG, red left half and blue right half, tagged to be shown rotated by 90 degrees."""
+    img = Image.new("RGB", (256, 128), (0, 0, 255))
+    img.paste((255, 0, 0), (0, 0, 128, 128))
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = 6
+    return encode(img, "JPEG", exif=exif.tobytes(), quality=95)
+
+
+@pytest.mark.parametrize("policy", POLICIES, ids=lambda policy: policy.version)
+def test_16bit_png_keeps_its_tones(png_16bit, policy):
+    pixels = sent_pixels(png_16bit, policy)
+    assert (pixels >= 250).mean() < 0.1
+    # Dark on the left, light on the right, as in the source
+    assert pixels[:, :8].mean() < 40 and pixels[:, -8:].mean() > 215
+
+
+@pytest.mark.parametrize("policy", POLICIES, ids=lambda policy: policy.version)
+def test_transparent_background_becomes_white(png_rgba, policy):
+    pixels = sent_pixels(png_rgba, policy)
+    assert pixels[2, 2].min() > 240
+    red, green, blue = pixels[pixels.shape[0] // 2, pixels.shape[1] // 2]
+    assert red > 200 and green < 60 and blue < 60
+
+
+@pytest.mark.parametrize("policy", POLICIES, ids=lambda policy: policy.version)
+def test_exif_orientation_is_applied(jpeg_rotated, policy):
+    pixels = sent_pixels(jpeg_rotated, policy)
+    with Image.open(io.BytesIO(jpeg_rotated)) as source:
+        expected = np.asarray(ImageOps.exif_transpose(source).resize(pixels.shape[1::-1]), dtype=np.int16)
+    assert pixels.shape[0] > pixels.shape[1]
+    assert np.abs(pixels - expected).mean() < 10
+
+
+def test_16bit_stats_are_not_blank(png_16bit):
+    with Image.open(io.BytesIO(png_16bit)) as img:
+        stats = image_stats(img)
+    assert stats.variance > 1000
@@ -0,0 +1,224 @@
+import asyncio
+import os
+import time
+
+from dotenv import load_dotenv
+from app import (ReviewItem, download_item, prepare_item, analyze_item, release_item, construct_image_url,
+                 record_auto_review_result, executor, MAX_IN_FLIGHT)
+from supabase_utils import (claim_images, renew_leases, reap_expired_leases, get_result_writer,
+                            image_limit, LEASE_SECONDS)
+from logging_config import logger, trace_id
+from metrics_utils import QUEUE_DEPTH, count_error, observe_stage
+from scheduler_utils import FairQueue
+
+load_dotenv()
+
+# Concurrent downloads and CPU-bound preparations
+WORKER_DOWNLOAD_CONCURRENCY = int(os.getenv("WORKER_DOWNLOAD_CONCURRENCY", "16"))
+WORKER_PREPARE_CONCURRENCY = int(os.getenv("WORKER_PREPARE_CONCURRENCY", str(os.cpu_count() or 2)))
+# Claimed images not yet written back; new rows are claimed as slots free up
+WORKER_MAX_OUTSTANDING = int(os.getenv("WORKER_MAX_OUTSTANDING", str(2 * image_limit)))
+# Backoff between claims while the queue is empty
+WORKER_IDLE_MIN = float(os.getenv("WORKER_IDLE_MIN", "1"))
+WORKER_IDLE_MAX = float(os.getenv("WORKER_IDLE_MAX", "30"))
+WORKER_REAP_INTERVAL = float(os.getenv("WORKER_REAP_INTERVAL", "60"))
+# Seconds to finish claimed images after a stop request; the rest are left to the lease reaper
+WORKER_SHUTDOWN_GRACE = float(os.getenv("WORKER_SHUTDOWN_GRACE", "120"))
+
+
+class ReviewWorker:
+    """
+    Continuous claim -> download -> prepare -> analyze -> write pipeline.
+
+    Each stage has its own pool of tasks connected by bounded queues, so a
+    slow image only holds up its own slot. Claimed rows wait in a FairQueue,
+    which starts them by priority, deadline and round-robin across jobs
+    rather than in claim order. New rows are claimed whenever
+    fewer than max_outstanding images are in progress, and claiming backs
+    off exponentially while nothing is waiting.
+    """
+
+    def __init__(self, status: str = "downloaded", on_result=None,
+                 max_outstanding: int = WORKER_MAX_OUTSTANDING,
+                 download_concurrency: int = WORKER_DOWNLOAD_CONCURRENCY,
+                 prepare_concurrency: int = WORKER_PREPARE_CONCURRENCY,
+                 analyze_concurrency: int = MAX_IN_FLIGHT):
+        self.status = status
+        self.on_result = on_result
+        self.max_outstanding = max_outstanding
+        self.download_concurrency = download_concurrency
+        self.prepare_concurrency = prepare_concurrency
+        self.analyze_concurrency = analyze_concurrency
+        self.success_count = 0
+        self.error_count = 0
+        self.in_flight_ids = set()
+        self._stopping = asyncio.Event()
+        self._slot_freed = asyncio.Event()
+
+    def stop(self):
+        """Stop claiming new work; images already claimed are finished."""
+        if not self._stopping.is_set():
+            logger.info("Worker stop requested. Finishing claimed images...")
+            self._stopping.set()
+            self._slot_freed.set()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stopping.is_set()
+
+    async def run(self):
+        """Run until stop() is called and the claimed images are drained."""
+        self._download_queue = FairQueue(maxsize=self.max_outstanding)
+        self._prepare_queue = asyncio.Queue(maxsize=self.prepare_concurrency * 2)
+        self._analyze_queue = asyncio.Queue(maxsize=self.analyze_concurrency * 2)
+        QUEUE_DEPTH.labels("download").set_function(self._download_queue.qsize)
+        QUEUE_DEPTH.labels("prepare").set_function(self._prepare_queue.qsize)
+        QUEUE_DEPTH.labels("analyze").set_function(self._analyze_queue.qsize)
+
+        stages = (
+            [asyncio.create_task(self._download_stage()) for _ in range(self.download_concurrency)]
+            + [asyncio.create_task(self._prepare_stage()) for _ in range(self.prepare_concurrency)]
+            + [asyncio.create_task(self._analyze_stage()) for _ in range(self.analyze_concurrency)]
+        )
+        heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+        await self._claim_loop()
+
+        # Drain everything already claimed, stage by stage
+        try:
+            await asyncio.wait_for(self._drain(), timeout=WORKER_SHUTDOWN_GRACE)
+        except asyncio.TimeoutError:
+            logger.warning(f"{len(self.in_flight_ids)} images unfinished after {WORKER_SHUTDOWN_GRACE}s; "
+                           f"leaving them to the lease reaper.")
+
+        for task in stages + [heartbeat]:
+            task.cancel()
+        await asyncio.gather(*stages, heartbeat, return_exceptions=True)
+
+        await asyncio.get_running_loop().run_in_executor(executor, get_result_writer().close)
+        logger.info("Worker stopped.")
+
+    async def _drain(self):
+        await self._download_queue.join()
+        await self._prepare_queue.join()
+        await self._analyze_queue.join()
+
+    async def _sleep(self, seconds: float):
+        """Sleep, waking early if a stop is requested."""
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _claim_loop(self):
+        loop = asyncio.get_running_loop()
+        idle_delay = WORKER_IDLE_MIN
+        last_reap = 0.0
+
+        while not self.stopping:
+            if time.monotonic() - last_reap >= WORKER_REAP_INTERVAL:
+                last_reap = time.monotonic()
+                try:
+                    await loop.run_in_executor(executor, reap_expired_leases, self.status)
+                except Exception as e:
+                    logger.error(f"Reaping expired leases failed: {e}")
+
+            capacity = self.max_outstanding - len(self.in_flight_ids)
+            if capacity <= 0:
+                self._slot_freed.clear()
+                await self._slot_freed.wait()
+                continue
+
+            try:
+                records = await loop.run_in_executor(executor, claim_images, self.status,
+                                                     min(image_limit, capacity))
+            except Exception as e:
+                logger.error(f"Claiming images failed: {e}")
+                records = []
+
+            if not records:
+                await self._sleep(idle_delay)
+                idle_delay = min(idle_delay * 2, WORKER_IDLE_MAX)
+                continue
+
+            idle_delay = WORKER_IDLE_MIN
+            for record in records:
+                self.in_flight_ids.add(record["id"])
+                await self._download_queue.put(record)
+
+    async def _heartbeat_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            if not self.in_flight_ids:
+                continue
+            try:
+                await loop.run_in_executor(executor, renew_leases, list(self.in_flight_ids))
+            except Exception as e:
+                logger.error(f"Lease heartbeat failed: {e}")
+
+    async def _download_stage(self):
+        while True:
+            record = await self._download_queue.get()
+            trace_id.set(record["id"])
+            try:
+                item = ReviewItem(image_id=record["id"], job_id=record["job_id"],
+                                  image_url=construct_image_url(record["job_id"], record["image_index"]))
+                try:
+                    # Waits while the memory budget is used up, which backs up the claim loop
+                    await download_item(item)
+                except Exception as e:
+                    item.category, item.details = "error", str(e)
+                await self._forward(item, self._prepare_queue)
+            finally:
+                self._download_queue.task_done()
+
+    async def _prepare_stage(self):
+        while True:
+            item = await self._prepare_queue.get()
+            trace_id.set(item.image_id)
+            try:
+                try:
+                    await prepare_item(item)
+                except Exception as e:
+                    count_error("prepare")
+                    logger.exception(f"Preparing image {item.image_id} failed")
+                    item.category, item.details = "error", str(e)
+                await self._forward(item, self._analyze_queue)
+            finally:
+                self._prepare_queue.task_done()
+
+    async def _analyze_stage(self):
+        while True:
+            item = await self._analyze_queue.get()
+            trace_id.set(item.image_id)
+            try:
+                try:
+                    await analyze_item(item)
+                except Exception as e:
+                    count_error("analyze")
+                    logger.exception(f"Analyzing image {item.image_id} failed")
+                    item.category, item.details = "error", str(e)
+                await self._finish(item)
+            finally:
+                self._analyze_queue.task_done()
+
+    async def _forward(self, item: ReviewItem, next_queue: asyncio.Queue):
+        """Pass the item to the next stage, or finish it if it already has a verdict."""
+        if item.done:
+            await self._finish(item)
+        else:
+            await next_queue.put(item)
+
+    async def _finish(self, item: ReviewItem):
+        observe_stage("total", time.perf_counter() - item.started)
+        record_auto_review_result(item.image_id, item.category, item.details)
+        await release_item(item)
+        if item.category == "error":
+            self.error_count += 1
+        else:
+            self.success_count += 1
+        self.in_flight_ids.discard(item.image_id)
+        self._slot_freed.set()
+        if self.on_result:
+            self.on_result(item)